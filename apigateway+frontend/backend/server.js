@@ -2,6 +2,8 @@ require('dotenv').config();
 const express = require('express');
 const cors = require('cors');
 const jwt = require('jsonwebtoken');
+const { Readable } = require('stream');
+const { randomUUID } = require('crypto');
 
 const app = express();
 const PORT = process.env.PORT || 3000;
@@ -10,9 +12,17 @@ const APP_PASSWORD = process.env.APP_PASSWORD;
 const JWT_SECRET = process.env.JWT_SECRET;
 const PYTHON_API_URL = process.env.PYTHON_API_URL || 'http://127.0.0.1:8000'; 
 
-app.use(cors());
+app.use(cors({ exposedHeaders: ['X-Request-ID', 'Retry-After'] }));
 app.use(express.json());
 
+// ID запиту: беремо з X-Request-ID або генеруємо, повертаємо клієнту
+// і передаємо в Python, щоб логи й метрики обох сервісів можна було зіставити
+app.use((req, res, next) => {
+  req.id = req.get('X-Request-ID') || randomUUID();
+  res.set('X-Request-ID', req.id);
+  next();
+});
+
 // Middleware авторизації
 function requireAuth(req, res, next) {
   const header = req.headers.authorization || '';
@@ -28,6 +38,27 @@ function requireAuth(req, res, next) {
   }
 }
 
+// Python сам підбирає варіант PERSONA під обраний формат та епоху,
+// тому передаємо їх окремими полями, а не текстом у message.
+// session_id: Python зберігає історію розмови сам, попередні відповіді
+// в prompt не вставляємо
+function buildPythonRequest({ prompt, responseFormat, phase, sessionId }) {
+  return {
+    message: prompt,
+    response_format: responseFormat || 'Email Response',
+    phase: phase || 'Late Hankins (2019+)',
+    session_id: sessionId || null,
+  };
+}
+
+// Python перевантажений (черга до Claude повна або вичерпано повтори):
+// передаємо клієнту 503 з Retry-After замість 502
+function forwardOverload(pythonResponse, data, res) {
+  const retryAfter = pythonResponse.headers.get('retry-after');
+  if (retryAfter) res.set('Retry-After', retryAfter);
+  return res.status(503).json({ error: 'Service busy, try again later', details: data });
+}
+
 // Ендпоінт логіну
 app.post('/auth', (req, res) => {
   const { password } = req.body;
@@ -40,38 +71,31 @@ app.post('/auth', (req, res) => {
 app.post('/api/chatmessage', requireAuth, async (req, res) => {
   try {
     // 1. Отримуємо дані від фронтенду
-    const { prompt, responseFormat, phase } = req.body;
+    const { prompt, responseFormat, phase, sessionId } = req.body;
 
     if (!prompt) {
       return res.status(400).json({ error: 'Prompt is required' });
     }
 
-    // 2. Формуємо розширене повідомлення для Python
-    // Ми вставляємо вибір користувача як системну інструкцію
-    const fullMessage = `
-[SYSTEM CONTEXT OVERRIDE]
-Current Configuration:
-- ERA/PHASE: ${phase || 'Late Hankins (2019+)'}
-- RESPONSE FORMAT: ${responseFormat || 'Email Response'}
-
-Please adhere strictly to the tone and structure defined in the PERSONA for this Era and Format.
-
-USER INPUT:
-${prompt}
-    `;
+    // 2. Формуємо запит для Python (формат і епоха — структуровані поля)
+    const pythonRequest = buildPythonRequest({ prompt, responseFormat, phase, sessionId });
 
     // 3. Відправляємо на Python API
-    // Важливо: відправляємо поле "message", бо Python чекає MessageRequest(message: str)
+    // Важливо: поля мають збігатися з MessageRequest(message, response_format, phase)
     const pythonResponse = await fetch(`${PYTHON_API_URL}/ask`, {
       method: 'POST',
-      headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({ message: fullMessage }),
+      headers: { 'Content-Type': 'application/json', 'X-Request-ID': req.id },
+      body: JSON.stringify(pythonRequest),
     });
 
     const data = await pythonResponse.json().catch(() => null);
 
+    if (pythonResponse.status === 503) {
+      return forwardOverload(pythonResponse, data, res);
+    }
+
     if (!pythonResponse.ok) {
-      console.error('Python API Error:', data);
+      console.error(`Python API Error [${req.id}]:`, data);
       return res.status(502).json({ error: 'Python API error', details: data });
     }
 
@@ -84,6 +108,51 @@ ${prompt}
   }
 });
 
+// Стрімінговий ендпоінт: прокидаємо Server-Sent Events від Python без буферизації
+app.post('/api/chatmessage/stream', requireAuth, async (req, res) => {
+  try {
+    const { prompt, responseFormat, phase, sessionId } = req.body;
+
+    if (!prompt) {
+      return res.status(400).json({ error: 'Prompt is required' });
+    }
+
+    const pythonRequest = buildPythonRequest({ prompt, responseFormat, phase, sessionId });
+
+    const pythonResponse = await fetch(`${PYTHON_API_URL}/ask/stream`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json', 'X-Request-ID': req.id },
+      body: JSON.stringify(pythonRequest),
+    });
+
+    if (!pythonResponse.ok || !pythonResponse.body) {
+      const data = await pythonResponse.json().catch(() => null);
+      if (pythonResponse.status === 503) {
+        return forwardOverload(pythonResponse, data, res);
+      }
+      console.error(`Python API Error [${req.id}]:`, data);
+      return res.status(502).json({ error: 'Python API error', details: data });
+    }
+
+    res.writeHead(200, {
+      'Content-Type': 'text/event-stream',
+      'Cache-Control': 'no-cache',
+      Connection: 'keep-alive',
+      'X-Accel-Buffering': 'no',
+    });
+
+    const upstream = Readable.fromWeb(pythonResponse.body);
+    // Клієнт закрив з'єднання — зупиняємо читання з Python
+    res.on('close', () => upstream.destroy());
+    upstream.pipe(res);
+
+  } catch (error) {
+    console.error('Server Error:', error);
+    if (res.headersSent) return res.end();
+    return res.status(500).json({ error: 'Internal server error', details: error.message });
+  }
+});
+
 app.listen(PORT, () => {
   console.log(`Node Server running on http://localhost:${PORT}`);
 });
\ No newline at end of file
@@ -1,15 +1,44 @@
 import os
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
+import time
+PROCESS_START = time.monotonic()
+
+import re
+import sys
+import copy
+import math
+import random
+import asyncio
+import json
+import queue
+import sqlite3
+import hashlib
+import signal
+import socket
+import threading
+import shutil
+import tempfile
+import uuid
+import functools
+import multiprocessing
+import multiprocessing.connection
+import concurrent.futures
+from collections import OrderedDict
+from contextvars import ContextVar
 from pathlib import Path
-import pdfplumber
-import docx
-import chromadb
-from sentence_transformers import SentenceTransformer
-import anthropic
-from fastapi import FastAPI
+from contextlib import asynccontextmanager, contextmanager
+import numpy as np
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from starlette.background import BackgroundTask
 import uvicorn
 from pydantic import BaseModel
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+    generate_latest, multiprocess
+)
 
 # ---------- CONFIG ----------
 from dotenv import load_dotenv 
@@ -17,8 +46,106 @@ load_dotenv()
 
 DOCS_FOLDER = "./docs"
 DB_PATH = "./professor_db"
+MANIFEST_PATH = os.path.join(DB_PATH, "ingest_manifest.json")
+# Prebuilt index to load into an empty database (see SNAPSHOTS)
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "")
+SUPPORTED_SUFFIXES = (".pdf", ".docx")
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", os.cpu_count() or 1))
+EXTRACT_TIMEOUT = float(os.getenv("EXTRACT_TIMEOUT", "600"))  # seconds per file
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+EMBED_MODEL_NAME = "all-MiniLM-L6-v2"
+# torch (sentence-transformers, the default) | onnx | onnx-int8
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "torch")
+EMBED_ONNX_FILE = "onnx/model.onnx"
+EMBED_ONNX_CACHE = os.path.join(DB_PATH, "onnx")
+# Kept outside DB_PATH so a rebuilt database does not re-embed known text
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", "./embed_cache")
+# all-MiniLM-L6-v2 reads at most 256 word pieces including [CLS]/[SEP]
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", "250"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "32"))
+CHUNKER_VERSION = f"tokens-{CHUNK_TOKENS}-{CHUNK_OVERLAP_TOKENS}"
+N_RESULTS = 6
+
+# HNSW parameters of a newly created collection (Chroma's defaults); an
+# existing one keeps its own. tools/inspect_db.py --sweep measures them.
+HNSW_M = int(os.getenv("HNSW_M", "16"))
+HNSW_CONSTRUCTION_EF = int(os.getenv("HNSW_CONSTRUCTION_EF", "100"))
+HNSW_SEARCH_EF = int(os.getenv("HNSW_SEARCH_EF", "10"))
+# Multi-worker serving: one read-only copy of the vector index for all workers
+SHARED_VECTOR_INDEX = os.getenv("SHARED_VECTOR_INDEX", "1") == "1"
+VECTOR_INDEX_PATH = os.path.join(DB_PATH, "vectors")
+
+# Context assembly: token budget for retrieved writings (measured in embedding
+# model word pieces, a close proxy for Claude tokens on English prose),
+# Chroma L2 distance cut-off (embeddings are normalized: 2 - 2 * cosine) and
+# the shingle overlap above which two passages count as duplicates
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1200"))
+CONTEXT_MAX_DISTANCE = float(os.getenv("CONTEXT_MAX_DISTANCE", "1.5"))
+CONTEXT_DUPLICATE_SIMILARITY = float(os.getenv("CONTEXT_DUPLICATE_SIMILARITY", "0.8"))
+
+# Few-shot exemplars from curated persona exchanges (see EXEMPLARS)
+EXEMPLARS_FOLDER = os.getenv("EXEMPLARS_FOLDER", "./exemplars")
+EXEMPLAR_MANIFEST_PATH = os.path.join(DB_PATH, "exemplar_manifest.json")
+EXEMPLAR_COUNT = int(os.getenv("EXEMPLAR_COUNT", "3"))
+EXEMPLAR_TOKEN_BUDGET = int(os.getenv("EXEMPLAR_TOKEN_BUDGET", "400"))
+
+# Hybrid retrieval: BM25 over the same chunks, fused with the vector hits
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "1") == "1"
+LEXICAL_STORE_PATH = os.path.join(DB_PATH, "lexical.sqlite3")
+LEXICAL_INDEX_PATH = os.path.join(DB_PATH, "bm25")
+RRF_K = 60
+QUERY_EMBED_CACHE_SIZE = int(os.getenv("QUERY_EMBED_CACHE_SIZE", "1024"))
+QUERY_BATCH_MAX_SIZE = int(os.getenv("QUERY_BATCH_MAX_SIZE", "32"))
+QUERY_BATCH_MAX_WAIT = float(os.getenv("QUERY_BATCH_MAX_WAIT_MS", "3")) / 1000
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", "512"))
+RETRIEVAL_CACHE_TTL = float(os.getenv("RETRIEVAL_CACHE_TTL", "600"))  # seconds
+
+# Near-duplicate chunks across drafts and re-exports are stored only once
+DEDUP_CHUNKS = os.getenv("DEDUP_CHUNKS", "1") == "1"
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", "0.8"))
+DEDUP_STORE_PATH = os.path.join(DB_PATH, "dedup.sqlite3")
+
+# Semantic answer cache (opt-in)
+ANSWER_CACHE = os.getenv("ANSWER_CACHE", "0") == "1"
+ANSWER_CACHE_PATH = os.path.join(DB_PATH, "answer_cache.sqlite3")
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "5000"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", str(7 * 24 * 3600)))  # seconds
 ANTHROPIC_API_KEY=os.getenv("ANTHROPIC_API_KEY")
 
+# Serving: WEB_WORKERS > 1 forks that many uvicorn workers sharing one socket
+PORT = int(os.getenv("PORT", "8000"))
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", "1"))
+
+CLAUDE_MODEL = "claude-opus-4-6"
+CLAUDE_MAX_TOKENS = 1200
+CLAUDE_TEMPERATURE = 0.4
+# Admission control in front of Claude (per worker): calls in flight, requests
+# allowed to wait for a slot and how long they may wait, then retries with
+# jittered exponential backoff on 429/529/5xx and connection errors
+CLAUDE_MAX_CONCURRENCY = int(os.getenv("CLAUDE_MAX_CONCURRENCY", "8"))
+CLAUDE_QUEUE_SIZE = int(os.getenv("CLAUDE_QUEUE_SIZE", "32"))
+CLAUDE_QUEUE_TIMEOUT = float(os.getenv("CLAUDE_QUEUE_TIMEOUT", "30"))  # seconds
+CLAUDE_TIMEOUT = float(os.getenv("CLAUDE_TIMEOUT", "120"))  # seconds per attempt
+CLAUDE_RETRIES = int(os.getenv("CLAUDE_RETRIES", "3"))
+CLAUDE_BACKOFF_BASE = float(os.getenv("CLAUDE_BACKOFF_BASE", "0.5"))  # seconds
+CLAUDE_BACKOFF_MAX = float(os.getenv("CLAUDE_BACKOFF_MAX", "20"))  # seconds
+
+# Conversation sessions: recent turns verbatim within HISTORY_TOKEN_BUDGET,
+# older ones folded into a summary of about SUMMARY_TOKEN_BUDGET tokens
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "1000"))
+# Also keep them in SQLite; required with several workers, which share nothing else
+SESSION_STORE = os.getenv("SESSION_STORE", "1" if WEB_WORKERS > 1 else "0") == "1"
+SESSION_STORE_PATH = os.path.join(DB_PATH, "sessions.sqlite3")
+SESSION_TTL = float(os.getenv("SESSION_TTL", str(7 * 24 * 3600)))  # seconds
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1500"))
+SUMMARY_TOKEN_BUDGET = int(os.getenv("SUMMARY_TOKEN_BUDGET", "300"))
+CLAUDE_SUMMARY_MODEL = os.getenv("CLAUDE_SUMMARY_MODEL", "claude-haiku-4-5")
+
+# Batch answering (/ask/batch, `professor_clone.py batch`)
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "1000"))
+
 PERSONA = """
 MACHINA HANKINSIANA: COMPLETE SYSTEM PROMPT
 Consolidated Instructions for AI Tribute to Professor James Hankins
@@ -444,139 +571,3296 @@ You are Machina Hankinsiana. Embody JH's voice, wisdom, and personality.
 END OF SYSTEM PROMPT
 """
 
-# ---------- LOAD CLAUDE ----------
+# ---------- PERSONA VARIANTS ----------
 
-claude = anthropic.Anthropic(
-    api_key=os.getenv("ANTHROPIC_API_KEY")
-)
+# The gateway knows which format and era the user picked, so there is no need
+# to send the guidance for the other two formats and eras on every call. PERSONA
+# is cut at its section headings into the shared core plus one block per
+# format and per era, and a variant is precomputed for every combination
+# (None = not specified, keep all of them), in a full and a compact form (see
+# EXEMPLARS). Each variant is a stable prefix of its own, so prompt caching
+# still applies per variant.
+
+FORMAT_KEYS = ("email", "conversational", "question")
+ERA_KEYS = ("early", "mid", "late")
+EXAMPLE_LINE = re.compile(r"(?m)^Example [^:\n]*:.*\n?")
+
+def split_sections(block, heading):
+    # -> (intro, [section, ...]) where every section starts with `heading`
+    parts = re.split(rf"(?m)^(?={heading})", block)
+    return parts[0], parts[1:]
+
+def build_persona_variants():
+    formats_at = PERSONA.index("RESPONSE FORMATS\n")
+    eras_at = PERSONA.index("ERA SELECTION\n")
+    shared_at = PERSONA.index("CHARACTERISTIC PHRASES BY CONTEXT\n")
+
+    head = PERSONA[:formats_at]
+    formats_intro, formats = split_sections(
+        PERSONA[formats_at:eras_at], r"FORMAT \d: "
+    )
+    eras_intro, eras = split_sections(
+        PERSONA[eras_at:shared_at], r"(?:EARLY|MID|LATE) HANKINS "
+    )
+    tail = PERSONA[shared_at:]
+    # Compact variants go with retrieved exemplars, which show the phrases
+    # and the format in use: the catalogue and the formats' example lines are
+    # dropped, the rule on Latin usage kept. The exemplars carry no era, so
+    # the era guidance stays whole.
+    compact_tail = PERSONA[PERSONA.index("CRITICAL - Latin Usage", shared_at):]
+
+    variants = {}
+    for f in (None,) + FORMAT_KEYS:
+        for e in (None,) + ERA_KEYS:
+            if f is None:
+                format_part = formats_intro + "".join(formats)
+            else:
+                format_part = (
+                    "RESPONSE FORMAT\nThe user has selected this format. "
+                    "You must respond accordingly:\n"
+                    + formats[FORMAT_KEYS.index(f)]
+                )
+            if e is None:
+                era_part = eras_intro + "".join(eras)
+            else:
+                era_part = (
+                    "ERA\nThe user has selected this era. "
+                    "You must embody this phase of JH's career:\n"
+                    + eras[ERA_KEYS.index(e)]
+                )
+            variants[(f, e, False)] = head + format_part + era_part + tail
+            variants[(f, e, True)] = (
+                head + EXAMPLE_LINE.sub("", format_part) + era_part + compact_tail
+            )
+    return variants
+
+PERSONA_VARIANTS = build_persona_variants()
+
+def format_key(response_format):
+    # Accepts the gateway's labels ("Email Response", "Conversational
+    # Feedback", "Answer a Question") or the bare keys.
+    value = (response_format or "").lower()
+    if "email" in value:
+        return "email"
+    if "conversation" in value:
+        return "conversational"
+    if "question" in value or "answer" in value:
+        return "question"
+    return None
+
+def era_key(phase):
+    # "Early Hankins (1990s)", "Mid Hankins (2000s-2010s)", "Late Hankins (2019+)"
+    value = (phase or "").lower()
+    for key in ERA_KEYS:
+        if value.startswith(key):
+            return key
+    return None
+
+def persona_for(response_format=None, phase=None, compact=False):
+    return PERSONA_VARIANTS[(format_key(response_format), era_key(phase), compact)]
+
+@functools.lru_cache(maxsize=None)
+def persona_tokens(response_format=None, phase=None, compact=False):
+    return count_tokens(persona_for(response_format, phase, compact))
+
+# ---------- LAZY RESOURCES ----------
+
+# torch/sentence-transformers, chromadb and anthropic are only imported when
+# first needed, so importing this module (tools, extraction workers) is cheap
+# and the server binds its port before the model is loaded. The warm-up thread
+# started by `lifespan` loads everything in the background; /readyz reports
+# when it is done.
+
+resources = {}
+resources_lock = threading.RLock()
+
+def lazy(name, factory):
+    if name not in resources:
+        with resources_lock:
+            if name not in resources:
+                resources[name] = factory()
+    return resources[name]
 
-app = FastAPI()
+# Retries are ours (see ADMISSION CONTROL), so the SDK's own are switched off
+
+def get_claude():
+    def make():
+        import anthropic
+        return anthropic.Anthropic(
+            api_key=os.getenv("ANTHROPIC_API_KEY"), max_retries=0, timeout=CLAUDE_TIMEOUT
+        )
+    return lazy("claude", make)
+
+def get_async_claude():
+    # Used by the streaming endpoint so generation never blocks a threadpool thread
+    def make():
+        import anthropic
+        return anthropic.AsyncAnthropic(
+            api_key=os.getenv("ANTHROPIC_API_KEY"), max_retries=0, timeout=CLAUDE_TIMEOUT
+        )
+    return lazy("async_claude", make)
+
+readiness = {"model": False, "collection": False, "ingest": False}
+startup_seconds = {}
+
+def warm_up():
+    try:
+        get_embed_model()
+        readiness["model"] = True
+        get_collection()
+        readiness["collection"] = True
+        if os.getenv("INGEST_ON_STARTUP", "1") == "1":
+            ingest_documents()
+        readiness["ingest"] = True
+        startup_seconds["ready"] = time.monotonic() - PROCESS_START
+        print(f"Ready in {startup_seconds['ready']:.1f}s")
+    except Exception as e:
+        print(f"Warm-up failed: {type(e).__name__}: {e}")
+
+@asynccontextmanager
+async def lifespan(app):
+    startup_seconds["imported"] = time.monotonic() - PROCESS_START
+    print(f"Imported in {startup_seconds['imported']:.1f}s")
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    yield
+
+app = FastAPI(lifespan=lifespan)
 
 class MessageRequest(BaseModel):
     message: str
+    response_format: str | None = None
+    phase: str | None = None
+    session_id: str | None = None
+
+# ---------- METRICS ----------
+
+# Every request gets an ID (taken from X-Request-ID when the gateway sends
+# one) and a dict of stage timings. span() times a stage into both that dict
+# and the professor_stage_seconds histogram; finish_request() logs the
+# timings as one JSON line and counts the request. The query embedding
+# batcher reports its batch sizes and per-query queue wait next to them.
+# /metrics serves the Prometheus text format.
+#
+# Stages: encode, vector_query, lexical_query, assemble_context, prompt,
+# claude_first_token (streaming only), claude, total
+
+STAGE_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0,
+)
+
+STAGE_SECONDS = Histogram(
+    "professor_stage_seconds", "Time spent in each stage of a chat request",
+    ["stage"], buckets=STAGE_BUCKETS
+)
+CLAUDE_TOKENS = Counter(
+    "professor_claude_tokens", "Claude tokens by kind",
+    ["kind"]  # input, output, cache_read, cache_write
+)
+REQUESTS = Counter(
+    "professor_requests", "Chat requests by endpoint and outcome",
+    ["endpoint", "outcome"]  # answered, cache_hit, rejected, error; partial for batches
+)
+QUERY_BATCH_SIZES = Histogram(
+    "professor_query_embed_batch_size", "Queries per query embedding batch",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128)
+)
+QUERY_BATCH_WAIT_SECONDS = Histogram(
+    "professor_query_embed_queue_wait_seconds",
+    "Time a query waits for its embedding batch to start",
+    buckets=STAGE_BUCKETS
+)
+
+request_id = ContextVar("request_id", default=None)
+request_timings = ContextVar("request_timings", default=None)
+request_started = ContextVar("request_started", default=None)
+
+@contextmanager
+def span(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+def observe(stage, seconds):
+    STAGE_SECONDS.labels(stage).observe(seconds)
+    timings = request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+def finish_request(endpoint, outcome):
+    start = request_started.get() or time.perf_counter()
+    observe("total", time.perf_counter() - start)
+    REQUESTS.labels(endpoint, outcome).inc()
+    timings = request_timings.get() or {}
+    print("Timing: " + json.dumps({
+        "request_id": request_id.get(),
+        "endpoint": endpoint,
+        "outcome": outcome,
+        **{f"{stage}_ms": round(seconds * 1000, 1) for stage, seconds in timings.items()},
+    }))
+
+@app.middleware("http")
+async def assign_request_id(request, call_next):
+    rid = request.headers.get("x-request-id") or uuid.uuid4().hex
+    request_id.set(rid)
+    request_timings.set({})
+    request_started.set(time.perf_counter())
+    response = await call_next(request)
+    response.headers["X-Request-ID"] = rid
+    return response
 
 # ---------- EMBEDDING MODEL ----------
 
-embed_model = SentenceTransformer("all-MiniLM-L6-v2")
+# The embedding backend is pluggable. "torch" is the sentence-transformers
+# model we have always used. "onnx" runs the model's ONNX export with ONNX
+# Runtime (already installed as a chromadb dependency), so no torch model is
+# loaded or run; "onnx-int8" is the same graph with weights dynamically quantized to
+# int8, produced once from the ONNX export and kept under professor_db/onnx/.
+# All three produce the same 384-dimensional normalized vectors, so they can
+# be swapped without re-ingesting; tools/embedding_parity.py checks that
+# retrieval results stay within tolerance and reports the speedup.
+
+def hub_model_name():
+    name = EMBED_MODEL_NAME
+    if not os.path.isdir(name) and "/" not in name:
+        name = f"sentence-transformers/{name}"
+    return name
+
+def embed_model_file(file_name):
+    if os.path.isdir(EMBED_MODEL_NAME):
+        return os.path.join(EMBED_MODEL_NAME, file_name)
+    from huggingface_hub import hf_hub_download
+    return hf_hub_download(hub_model_name(), file_name)
+
+def quantized_model_file():
+    target = os.path.join(
+        EMBED_ONNX_CACHE, f"{os.path.basename(EMBED_MODEL_NAME)}-int8.onnx"
+    )
+    if not os.path.exists(target):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        os.makedirs(EMBED_ONNX_CACHE, exist_ok=True)
+        tmp = target + ".tmp"
+        quantize_dynamic(
+            embed_model_file(EMBED_ONNX_FILE), tmp, weight_type=QuantType.QInt8
+        )
+        os.replace(tmp, target)
+        print(f"Quantized embedding model written to {target}")
+    return target
+
+class OnnxEmbedder:
+
+    # Covers the part of the SentenceTransformer interface this module uses:
+    # encode() and tokenizer. Pooling matches all-MiniLM-L6-v2's own
+    # pipeline: mean over the last hidden state, then L2 normalization.
+
+    def __init__(self, model_path, tokenizer, max_length=256):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        self.session = onnxruntime.InferenceSession(
+            model_path, options, providers=["CPUExecutionProvider"]
+        )
+        self.inputs = [i.name for i in self.session.get_inputs()]
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+
+    def get_sentence_embedding_dimension(self):
+        return self.session.get_outputs()[0].shape[-1]
+
+    def encode(self, sentences, batch_size=32, **kwargs):
+        if isinstance(sentences, str):
+            return self.encode([sentences], batch_size)[0]
+        # Longest first, like sentence-transformers, to keep padding low
+        order = sorted(range(len(sentences)), key=lambda i: -len(sentences[i]))
+        vectors = [None] * len(sentences)
+        for start in range(0, len(order), batch_size):
+            rows = order[start:start + batch_size]
+            encoded = self.tokenizer(
+                [sentences[i] for i in rows],
+                padding=True,
+                truncation=True,
+                max_length=self.max_length,
+                return_tensors="np"
+            )
+            feeds = {
+                name: encoded[name].astype(np.int64)
+                for name in self.inputs if name in encoded
+            }
+            if "token_type_ids" in self.inputs and "token_type_ids" not in feeds:
+                feeds["token_type_ids"] = np.zeros_like(feeds["input_ids"])
+            hidden = self.session.run(None, feeds)[0]
+            mask = encoded["attention_mask"][..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            for i, vector in zip(rows, pooled):
+                vectors[i] = vector
+        if not vectors:
+            return np.zeros((0, self.get_sentence_embedding_dimension()), dtype=np.float32)
+        return np.stack(vectors)
+
+def load_tokenizer():
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(hub_model_name())
+
+def load_embed_model(backend=EMBED_BACKEND):
+    if backend == "torch":
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(EMBED_MODEL_NAME)
+    if backend == "onnx":
+        return OnnxEmbedder(embed_model_file(EMBED_ONNX_FILE), load_tokenizer())
+    if backend == "onnx-int8":
+        return OnnxEmbedder(quantized_model_file(), load_tokenizer())
+    raise ValueError(f"Unknown EMBED_BACKEND: {backend}")
+
+def get_embed_model():
+    return lazy("embed_model", load_embed_model)
+
+def get_tokenizer():
+    # Extraction workers only need the tokenizer, not the whole model
+    def make():
+        if "embed_model" in resources:
+            return resources["embed_model"].tokenizer
+        return load_tokenizer()
+    return lazy("tokenizer", make)
+
+# ---------- EMBEDDING CACHE ----------
+
+# Re-chunking, a rebuilt collection or a fresh professor_db volume used to
+# mean embedding the whole corpus again, though most chunk texts had been
+# embedded before. Ingest now goes through a content-addressed cache. The key
+# is a hash of the model (name and backend) and the chunk text with its
+# whitespace collapsed. The value is a float16 row in a memory-mapped matrix,
+# and an SQLite table maps keys to rows. The cache lives outside DB_PATH so it
+# outlives the database. Freshly encoded vectors also reach Chroma rounded
+# through float16, so a rebuild from the cache gives the same index as the
+# first build.
+
+EMBED_CACHE_GROWTH = 4096  # rows added whenever the matrix file is full
+
+class EmbeddingCache:
+
+    def __init__(self, path, model_key):
+        self.path = os.path.join(path, re.sub(r"[^\w.-]+", "_", model_key))
+        self.model_key = model_key
+        self.db = None
+        self.dim = None
+        self.vectors = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def open(self):
+        if self.db is None:
+            os.makedirs(self.path, exist_ok=True)
+            self.db = sqlite3.connect(
+                os.path.join(self.path, "index.sqlite3"), check_same_thread=False
+            )
+            self.db.execute(
+                "create table if not exists rows (key blob primary key, row integer not null)"
+            )
+            self.db.execute(
+                "create table if not exists meta (name text primary key, value text not null)"
+            )
+            self.db.commit()
+            row = self.db.execute("select value from meta where name = 'dim'").fetchone()
+            if row:
+                self.dim = int(row[0])
+        return self.db
+
+    def key(self, text):
+        text = " ".join(text.split())
+        return hashlib.blake2b(
+            f"{self.model_key}\0{text}".encode("utf-8"), digest_size=16
+        ).digest()
+
+    def map(self, rows=0):
+        # (Re)maps the matrix file, growing it to hold at least `rows` rows.
+        # Another process may have grown it since it was last mapped.
+        file = os.path.join(self.path, "vectors.f16")
+        row_bytes = self.dim * 2
+        size = os.path.getsize(file) if os.path.exists(file) else 0
+        if size < rows * row_bytes:
+            size = (rows + EMBED_CACHE_GROWTH) * row_bytes
+            with open(file, "ab") as f:
+                f.truncate(size)
+        self.vectors = np.memmap(
+            file, dtype=np.float16, mode="r+", shape=(size // row_bytes, self.dim)
+        ) if size else None
+
+    def lookup(self, keys):
+        # -> {key: row}
+        found = {}
+        keys = list(keys)
+        for i in range(0, len(keys), 500):
+            part = keys[i:i + 500]
+            found.update(self.db.execute(
+                f"select key, row from rows where key in ({','.join('?' * len(part))})",
+                part
+            ).fetchall())
+        return found
+
+    def put(self, keys, vectors):
+        db = self.db
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+            db.execute(
+                "insert or replace into meta (name, value) values ('dim', ?)", (str(self.dim),)
+            )
+            db.commit()
+        # One writer at a time appends rows; the matrix is flushed before the
+        # index points at the new rows
+        db.execute("begin immediate")
+        try:
+            start = db.execute("select coalesce(max(row) + 1, 0) from rows").fetchone()[0]
+            self.map(start + len(keys))
+            self.vectors[start:start + len(keys)] = vectors
+            self.vectors.flush()
+            db.executemany(
+                "insert or ignore into rows (key, row) values (?, ?)",
+                [(key, start + i) for i, key in enumerate(keys)]
+            )
+            db.commit()
+        except BaseException:
+            db.rollback()
+            raise
+
+    def encode(self, texts, batch_size=EMBED_BATCH_SIZE):
+        # -> float32 matrix with one row per text. Only texts the cache has
+        # not seen are encoded, and the model is not even loaded if there
+        # are none.
+        with self.lock:
+            self.open()
+            keys = [self.key(text) for text in texts]
+            found = self.lookup(set(keys))
+            todo = {}
+            for key, text in zip(keys, texts):
+                if key not in found:
+                    todo.setdefault(key, text)
+            if todo:
+                vectors = np.asarray(
+                    get_embed_model().encode(list(todo.values()), batch_size=batch_size),
+                    dtype=np.float32
+                )
+                self.put(list(todo), vectors.astype(np.float16))
+                found.update(self.lookup(todo))
+            rows = [found[key] for key in keys]
+            if self.vectors is None or max(rows) >= len(self.vectors):
+                self.map()
+            misses = sum(1 for key in keys if key in todo)
+            self.misses += misses
+            self.hits += len(keys) - misses
+            return np.asarray(self.vectors[rows], dtype=np.float32)
+
+    def stats(self):
+        with self.lock:
+            self.open()
+            entries = self.db.execute("select count(*) from rows").fetchone()[0]
+            size = sum(
+                os.path.getsize(os.path.join(self.path, name))
+                for name in os.listdir(self.path)
+            )
+            lookups = self.hits + self.misses
+            return {
+                "entries": entries,
+                "bytes": size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+embedding_cache = EmbeddingCache(EMBED_CACHE_PATH, f"{EMBED_MODEL_NAME}-{EMBED_BACKEND}")
 
 # ---------- VECTOR DATABASE ----------
 
-client = chromadb.PersistentClient(path=DB_PATH)
-collection = client.get_or_create_collection("professor")
+def get_client():
+    def make():
+        import chromadb
+        return chromadb.PersistentClient(path=DB_PATH)
+    return lazy("client", make)
+
+def hnsw_metadata():
+    return {
+        "hnsw:M": HNSW_M,
+        "hnsw:construction_ef": HNSW_CONSTRUCTION_EF,
+        "hnsw:search_ef": HNSW_SEARCH_EF,
+    }
+
+def get_collection():
+    return lazy(
+        "collection",
+        lambda: get_client().get_or_create_collection("professor", metadata=hnsw_metadata())
+    )
+
+# ---------- SHARED VECTOR INDEX ----------
+
+# Every worker that queried Chroma loaded its own copy of the collection's
+# HNSW index. With SHARED_VECTOR_INDEX on, serve_workers() has the index
+# compiled, like the BM25 arrays, into professor_db/vectors/: an hnswlib
+# graph built from the stored embeddings with the collection's HNSW settings,
+# plus the chunk ids in label order. The parent loads it before forking, so
+# the workers share its pages copy-on-write; searching does not write to
+# them. Workers still open Chroma, but only to read documents and metadata
+# of the hits from its SQLite store, which does not load Chroma's own index.
+# The compiled index is rebuilt when the ingest manifest, the chunk count or
+# the HNSW settings change, which only happens when serve_workers() starts.
+# A `reindex` run while the server is up rewrites chunks under the same ids,
+# so whenever the manifest changes the workers check the index's version
+# again, and on a mismatch go to Chroma until the next restart. Between an
+# ingest batch reaching Chroma and its manifest update, hits may still come
+# from the old vectors. Without the compiled index, queries go to Chroma as
+# before.
+
+def vector_index_version(collection):
+    # Ingest and snapshot import rewrite the manifest whenever chunks change
+    digest = file_sha256(MANIFEST_PATH) if os.path.exists(MANIFEST_PATH) else ""
+    return f"{digest}:{collection.count()}:{HNSW_M}:{HNSW_CONSTRUCTION_EF}"
+
+def compile_vector_index(page_size=5000):
+    # Opens Chroma: run it in a child process, never in serve_workers() itself
+    import hnswlib
+
+    collection = get_collection()
+    version = vector_index_version(collection)
+    meta_path = os.path.join(VECTOR_INDEX_PATH, "meta.json")
+    if os.path.exists(meta_path):
+        with open(meta_path, encoding="utf-8") as f:
+            if json.load(f)["version"] == version:
+                return
+
+    start = time.monotonic()
+    n = collection.count()
+    index = None
+    ids = []
+    while True:
+        page = collection.get(include=["embeddings"], limit=page_size, offset=len(ids))
+        if not len(page["ids"]):
+            break
+        vectors = np.asarray(page["embeddings"], dtype=np.float32)
+        if index is None:
+            # Chroma's default space: squared L2, the distances it reports
+            index = hnswlib.Index(space="l2", dim=vectors.shape[1])
+            index.init_index(
+                max_elements=n, M=HNSW_M, ef_construction=HNSW_CONSTRUCTION_EF
+            )
+        index.add_items(vectors, np.arange(len(ids), len(ids) + len(vectors)))
+        ids.extend(page["ids"])
+
+    tmp = VECTOR_INDEX_PATH + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    if index is not None:
+        index.save_index(os.path.join(tmp, "index.bin"))
+    with open(os.path.join(tmp, "ids.json"), "w", encoding="utf-8") as f:
+        json.dump(ids, f)
+    with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({
+            "version": version,
+            "chunks": len(ids),
+            "dim": index.dim if index is not None else 0,
+        }, f)
+
+    old = VECTOR_INDEX_PATH + ".old"
+    shutil.rmtree(old, ignore_errors=True)
+    if os.path.exists(VECTOR_INDEX_PATH):
+        os.replace(VECTOR_INDEX_PATH, old)
+    os.replace(tmp, VECTOR_INDEX_PATH)
+    shutil.rmtree(old, ignore_errors=True)
+    print(f"Vector index: {len(ids)} chunks compiled in {time.monotonic() - start:.1f}s")
+
+def load_vector_index():
+    # -> (hnswlib index, chunk ids by label, version), or None for an empty
+    # or missing index
+    meta_path = os.path.join(VECTOR_INDEX_PATH, "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, encoding="utf-8") as f:
+        meta = json.load(f)
+    if not meta["chunks"]:
+        return None
+
+    import hnswlib
+    index = hnswlib.Index(space="l2", dim=meta["dim"])
+    index.load_index(os.path.join(VECTOR_INDEX_PATH, "index.bin"), max_elements=meta["chunks"])
+    index.set_ef(HNSW_SEARCH_EF)
+    # Per-query threads would be started in every worker for nothing
+    index.set_num_threads(1)
+    with open(os.path.join(VECTOR_INDEX_PATH, "ids.json"), encoding="utf-8") as f:
+        ids = json.load(f)
+    return index, ids, meta["version"]
+
+vector_index_checks = {}  # manifest stamp -> whether the shared index matches
+
+def vector_index_current(collection, version):
+    # Hashing the manifest takes a while on a big corpus, so this is redone
+    # only when another ingest has rewritten it
+    stamp = manifest_stamp()
+    if stamp not in vector_index_checks:
+        current = vector_index_version(collection) == version
+        if not current:
+            print("The collection changed since the vector index was compiled: querying Chroma")
+        vector_index_checks.clear()
+        vector_index_checks[stamp] = current
+    return vector_index_checks[stamp]
+
+def query_vectors(collection, embeddings, n_results):
+    # collection.query() for precomputed embeddings, answered from the shared
+    # index when serve_workers() loaded one
+    shared = resources.get("vector_index")
+    if shared is None or not vector_index_current(collection, shared[2]):
+        return collection.query(query_embeddings=embeddings, n_results=n_results)
+
+    index, ids, _ = shared
+    labels, distances = index.knn_query(
+        np.asarray(embeddings, dtype=np.float32), k=min(n_results, len(ids))
+    )
+    found = collection.get(
+        ids=list(dict.fromkeys(ids[label] for label in labels.ravel())),
+        include=["documents", "metadatas"]
+    )
+    # Chunks deleted since the index was compiled are no longer found
+    rows = dict(zip(found["ids"], zip(found["documents"], found["metadatas"])))
+    results = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+    for row_labels, row_distances in zip(labels, distances):
+        hits = [
+            (ids[label], float(distance))
+            for label, distance in zip(row_labels, row_distances)
+            if ids[label] in rows
+        ]
+        results["ids"].append([chunk_id for chunk_id, _ in hits])
+        results["documents"].append([rows[chunk_id][0] for chunk_id, _ in hits])
+        results["metadatas"].append([rows[chunk_id][1] for chunk_id, _ in hits])
+        results["distances"].append([distance for _, distance in hits])
+    return results
+
+# ---------- LEXICAL INDEX ----------
+
+# Dense MiniLM retrieval is weak on exact names and Latin phrases, so the same
+# chunks are also indexed for BM25. Ingest writes per-chunk term counts to a
+# small SQLite store, which is cheap to update chunk by chunk, and then
+# compiles it into flat numpy arrays (CSR postings sorted by term) under
+# professor_db/bm25/. Queries memory-map those arrays, and reload them when
+# another process (e.g. `reindex`) compiles a newer version.
+
+LEXICAL_STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have he her his i in is it its "
+    "me my not of on or our she so that the their them they this to was we "
+    "were what which who will with you your".split()
+)
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+def lexical_terms(text):
+    return [
+        t for t in re.findall(r"\w+", text.lower())
+        if t not in LEXICAL_STOPWORDS
+    ]
+
+class LexicalIndex:
+
+    def __init__(self, store_path, index_path):
+        self.store_path = store_path
+        self.index_path = index_path
+        self.db = None
+        self.dirty = False
+        self.loaded = None
+        self.loaded_version = None
+        self.lock = threading.Lock()
+
+    # --- ingest side ---
+
+    def store(self):
+        if self.db is None:
+            os.makedirs(os.path.dirname(self.store_path), exist_ok=True)
+            self.db = sqlite3.connect(self.store_path, check_same_thread=False)
+            self.db.execute(
+                "create table if not exists chunks ("
+                " doc integer primary key, id text unique not null,"
+                " length integer not null)"
+            )
+            self.db.execute(
+                "create table if not exists postings ("
+                " doc integer not null, term text not null, tf integer not null)"
+            )
+            self.db.execute(
+                "create index if not exists postings_doc on postings (doc)"
+            )
+        return self.db
+
+    def count(self):
+        return self.store().execute("select count(*) from chunks").fetchone()[0]
+
+    def delete(self, ids):
+        db = self.store()
+        for chunk_id in ids:
+            row = db.execute("select doc from chunks where id = ?", (chunk_id,)).fetchone()
+            if row:
+                db.execute("delete from postings where doc = ?", row)
+                db.execute("delete from chunks where doc = ?", row)
+        db.commit()
+        self.dirty = True
+
+    def add(self, ids, documents):
+        self.delete(ids)
+        db = self.store()
+        for chunk_id, document in zip(ids, documents):
+            terms = lexical_terms(document)
+            cur = db.execute(
+                "insert into chunks (id, length) values (?, ?)",
+                (chunk_id, len(terms))
+            )
+            counts = {}
+            for t in terms:
+                counts[t] = counts.get(t, 0) + 1
+            db.executemany(
+                "insert into postings (doc, term, tf) values (?, ?, ?)",
+                [(cur.lastrowid, t, n) for t, n in counts.items()]
+            )
+        db.commit()
+        self.dirty = True
+
+    def compile(self, page_size=65536):
+        # Postings are streamed into preallocated .npy files, so the index
+        # never exists as Python lists
+        db = self.store()
+        tmp = self.index_path + ".tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+
+        # One read transaction, so the counts match what is read after them
+        db.execute("begin")
+        try:
+            n_docs = db.execute("select count(*) from chunks").fetchone()[0]
+            n_postings = db.execute("select count(*) from postings").fetchone()[0]
+            docs = np.empty(n_docs, dtype=np.int64)
+            doc_len = np.empty(n_docs, dtype=np.float32)
+            doc_ids = []
+            cur = db.execute("select doc, id, length from chunks order by doc")
+            for i, (doc, chunk_id, length) in enumerate(cur):
+                docs[i] = doc
+                doc_ids.append(chunk_id)
+                doc_len[i] = length
+
+            postings_doc = np.lib.format.open_memmap(
+                os.path.join(tmp, "postings_doc.npy"), mode="w+",
+                dtype=np.int32, shape=(n_postings,)
+            )
+            postings_tf = np.lib.format.open_memmap(
+                os.path.join(tmp, "postings_tf.npy"), mode="w+",
+                dtype=np.float32, shape=(n_postings,)
+            )
+            terms = []
+            offsets = []
+            n = 0
+            cur = db.execute("select term, doc, tf from postings order by term, doc")
+            while rows := cur.fetchmany(page_size):
+                for i, (term, _, _) in enumerate(rows, n):
+                    if not terms or terms[-1] != term:
+                        terms.append(term)
+                        offsets.append(i)
+                # Row ids -> dense positions in doc_ids/doc_len
+                postings_doc[n:n + len(rows)] = np.searchsorted(
+                    docs, np.fromiter((r[1] for r in rows), dtype=np.int64, count=len(rows))
+                )
+                postings_tf[n:n + len(rows)] = np.fromiter(
+                    (r[2] for r in rows), dtype=np.float32, count=len(rows)
+                )
+                n += len(rows)
+            offsets.append(n)
+        finally:
+            db.commit()
+        postings_doc.flush()
+        postings_tf.flush()
+        del postings_doc, postings_tf
+
+        np.save(os.path.join(tmp, "offsets.npy"), np.array(offsets, dtype=np.int64))
+        np.save(os.path.join(tmp, "doc_len.npy"), doc_len)
+        with open(os.path.join(tmp, "terms.json"), "w", encoding="utf-8") as f:
+            json.dump(terms, f)
+        with open(os.path.join(tmp, "doc_ids.json"), "w", encoding="utf-8") as f:
+            json.dump(doc_ids, f)
+        with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"version": time.time(), "docs": n_docs, "terms": len(terms)}, f)
+
+        old = self.index_path + ".old"
+        shutil.rmtree(old, ignore_errors=True)
+        if os.path.exists(self.index_path):
+            os.replace(self.index_path, old)
+        os.replace(tmp, self.index_path)
+        shutil.rmtree(old, ignore_errors=True)
+        self.dirty = False
+        print(f"Lexical index: {n_docs} chunks, {len(terms)} terms, {n} postings")
+
+    # --- query side ---
+
+    def load(self):
+        meta_path = os.path.join(self.index_path, "meta.json")
+        try:
+            version = os.stat(meta_path).st_mtime
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            if version != self.loaded_version:
+                path = self.index_path
+                with open(os.path.join(path, "terms.json"), encoding="utf-8") as f:
+                    terms = json.load(f)
+                with open(os.path.join(path, "doc_ids.json"), encoding="utf-8") as f:
+                    doc_ids = json.load(f)
+                doc_len = np.load(os.path.join(path, "doc_len.npy"), mmap_mode="r")
+                self.loaded = {
+                    "terms": {t: i for i, t in enumerate(terms)},
+                    "doc_ids": doc_ids,
+                    "offsets": np.load(os.path.join(path, "offsets.npy"), mmap_mode="r"),
+                    "postings_doc": np.load(os.path.join(path, "postings_doc.npy"), mmap_mode="r"),
+                    "postings_tf": np.load(os.path.join(path, "postings_tf.npy"), mmap_mode="r"),
+                    "doc_len": doc_len,
+                    "avgdl": float(doc_len.mean()) if len(doc_len) else 0.0,
+                }
+                self.loaded_version = version
+            return self.loaded
+
+    def search(self, text, k):
+        # -> [(chunk_id, score)], best first
+        index = self.load()
+        if not index or not index["doc_ids"]:
+            return []
+
+        n_docs = len(index["doc_ids"])
+        scores = np.zeros(n_docs, dtype=np.float32)
+        for term in set(lexical_terms(text)):
+            i = index["terms"].get(term)
+            if i is None:
+                continue
+            start, end = index["offsets"][i], index["offsets"][i + 1]
+            docs = index["postings_doc"][start:end]
+            tf = index["postings_tf"][start:end]
+            df = end - start
+            idf = np.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * index["doc_len"][docs] / index["avgdl"])
+            scores[docs] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+
+        k = min(k, n_docs)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(index["doc_ids"][i], float(scores[i])) for i in top if scores[i] > 0]
+
+lexical_index = LexicalIndex(LEXICAL_STORE_PATH, LEXICAL_INDEX_PATH)
+
+def backfill_lexical_index(collection, page_size=1000):
+    # Collections built before the lexical index existed
+    offset = 0
+    while True:
+        page = collection.get(include=["documents"], limit=page_size, offset=offset)
+        if not page["ids"]:
+            break
+        lexical_index.add(page["ids"], page["documents"])
+        offset += len(page["ids"])
+    print(f"Lexical index backfilled with {offset} chunks.")
+
+# ---------- NEAR-DUPLICATE CHUNKS ----------
+
+# ./docs holds drafts, final versions and re-exported PDFs of the same essays,
+# so without this the same passage would be embedded and stored once per copy
+# and take several of the N_RESULTS slots. Ingest fingerprints every chunk
+# with a MinHash of its word 3-gram shingles (the ones assemble_context
+# compares) and looks it up in an LSH table of DEDUP_BANDS bands. A chunk whose
+# estimated Jaccard similarity to a stored chunk reaches DEDUP_THRESHOLD is
+# neither embedded nor stored. It is recorded as a duplicate of that
+# "canonical" chunk instead, whose "also_in" metadata lists where else the
+# passage appears. Signatures, the band hashes of the LSH table and the
+# duplicates live in SQLite and are looked up chunk by chunk, so memory stays
+# flat however large the corpus grows.
+# When a canonical chunk goes away with its file, the files holding its
+# duplicates are read again so the passage stays indexed.
+
+DEDUP_PERMUTATIONS = 128
+DEDUP_BANDS = 32
+DEDUP_SEED = 1
+MERSENNE_61 = (1 << 61) - 1
+
+class DedupIndex:
+
+    def __init__(self, path, threshold=DEDUP_THRESHOLD, bands=DEDUP_BANDS):
+        self.path = path
+        self.threshold = threshold
+        self.bands = bands
+        rng = np.random.RandomState(DEDUP_SEED)
+        self.a = rng.randint(1, 1 << 32, size=DEDUP_PERMUTATIONS, dtype=np.uint64)
+        self.b = rng.randint(0, 1 << 32, size=DEDUP_PERMUTATIONS, dtype=np.uint64)
+        # Byte range of every band in a signature's bytes
+        self.band_bytes = [
+            (4 * int(band[0]), 4 * int(band[-1]) + 4)
+            for band in np.array_split(np.arange(DEDUP_PERMUTATIONS), bands)
+        ]
+        self.db = None
+
+    def store(self):
+        if self.db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            db.execute(
+                "create table if not exists fingerprints ("
+                " chunk integer primary key, id text unique not null,"
+                " signature blob not null)"
+            )
+            # One row per band of every stored chunk's signature
+            db.execute(
+                "create table if not exists buckets ("
+                " key integer not null, chunk integer not null,"
+                " primary key (key, chunk)) without rowid"
+            )
+            db.execute(
+                "create table if not exists duplicates ("
+                " id text primary key, canonical text not null, tag text not null)"
+            )
+            db.execute(
+                "create index if not exists duplicates_canonical on duplicates (canonical)"
+            )
+            self.db = db
+            legacy = db.execute(
+                "select 1 from sqlite_master where type = 'table' and name = 'signatures'"
+            ).fetchone()
+            if legacy:
+                self.migrate()
+        return self.db
+
+    def migrate(self):
+        # Stores written before the LSH buckets moved to SQLite
+        cur = self.db.execute("select id, signature from signatures")
+        n = 0
+        while rows := cur.fetchmany(1000):
+            for chunk_id, blob in rows:
+                self.add(chunk_id, np.frombuffer(blob, dtype=np.uint32))
+            n += len(rows)
+        self.db.execute("drop table signatures")
+        self.db.commit()
+        print(f"Dedup index: {n} signatures moved to the bucket table")
+
+    def count(self):
+        return self.store().execute("select count(*) from fingerprints").fetchone()[0]
+
+    def stats(self):
+        db = self.store()
+        stored = db.execute("select count(*) from fingerprints").fetchone()[0]
+        duplicates = db.execute("select count(*) from duplicates").fetchone()[0]
+        total = stored + duplicates
+        return {
+            "chunks": stored,
+            "duplicates": duplicates,
+            "shrink": duplicates / total if total else 0.0,
+        }
+
+    def signature(self, text):
+        hashes = np.array([
+            int.from_bytes(
+                hashlib.blake2b(" ".join(s).encode("utf-8"), digest_size=4).digest(), "little"
+            )
+            for s in shingles(text)
+        ], dtype=np.uint64)
+        # (a * x + b) mod p, one column per permutation; the uint64 product
+        # may wrap, which only changes which hash functions these are
+        permuted = (hashes[:, None] * self.a + self.b) % MERSENNE_61
+        return (permuted & 0xFFFFFFFF).min(axis=0).astype(np.uint32)
+
+    def band_keys(self, signature):
+        # One signed 64-bit hash per band, tagged with the band number. A
+        # collision only adds a candidate, which find() then compares.
+        data = signature.tobytes()
+        return [
+            int.from_bytes(
+                hashlib.blake2b(bytes([i]) + data[start:end], digest_size=8).digest(),
+                "little", signed=True
+            )
+            for i, (start, end) in enumerate(self.band_bytes)
+        ]
+
+    def find(self, signature):
+        # -> (canonical chunk id, estimated similarity) of the closest stored
+        # chunk at or above the threshold, or None
+        keys = self.band_keys(signature)
+        rows = self.store().execute(
+            "select id, signature from fingerprints where chunk in"
+            f" (select chunk from buckets where key in ({','.join('?' * len(keys))}))",
+            keys
+        ).fetchall()
+        best = None
+        for chunk_id, blob in rows:
+            similarity = float(np.mean(np.frombuffer(blob, dtype=np.uint32) == signature))
+            if similarity >= self.threshold and (best is None or similarity > best[1]):
+                best = (chunk_id, similarity)
+        return best
+
+    def forget(self, chunk_id):
+        # -> whether chunk_id had a signature
+        db = self.store()
+        row = db.execute(
+            "select chunk, signature from fingerprints where id = ?", (chunk_id,)
+        ).fetchone()
+        if row is None:
+            return False
+        chunk, blob = row
+        db.executemany(
+            "delete from buckets where key = ? and chunk = ?",
+            [(key, chunk) for key in self.band_keys(np.frombuffer(blob, dtype=np.uint32))]
+        )
+        db.execute("delete from fingerprints where chunk = ?", (chunk,))
+        return True
+
+    def add(self, chunk_id, signature):
+        db = self.store()
+        self.forget(chunk_id)
+        cur = db.execute(
+            "insert into fingerprints (id, signature) values (?, ?)",
+            (chunk_id, signature.tobytes())
+        )
+        db.executemany(
+            "insert or ignore into buckets (key, chunk) values (?, ?)",
+            [(key, cur.lastrowid) for key in self.band_keys(signature)]
+        )
+
+    def add_duplicate(self, chunk_id, canonical, tag):
+        self.store().execute(
+            "insert or replace into duplicates (id, canonical, tag) values (?, ?, ?)",
+            (chunk_id, canonical, tag)
+        )
+
+    def drop(self, ids):
+        # Forgets chunks that are about to be deleted or rewritten.
+        # -> (the ids that may be stored in the collection, canonical ids
+        #     whose list of duplicates changed)
+        db = self.store()
+        stored = []
+        touched = set()
+        for chunk_id in ids:
+            row = db.execute(
+                "select canonical from duplicates where id = ?", (chunk_id,)
+            ).fetchone()
+            if row is not None:
+                db.execute("delete from duplicates where id = ?", (chunk_id,))
+                touched.add(row[0])
+                continue
+            stored.append(chunk_id)
+            self.forget(chunk_id)
+        return stored, touched - set(stored)
+
+    def known(self, ids):
+        # -> the ids among `ids` that are stored chunks, not duplicates
+        db = self.store()
+        ids = list(ids)
+        found = set()
+        for i in range(0, len(ids), 500):
+            part = ids[i:i + 500]
+            found.update(r[0] for r in db.execute(
+                f"select id from fingerprints where id in ({','.join('?' * len(part))})",
+                part
+            ))
+        return found
+
+    def signatures(self, ids):
+        # -> {chunk id: signature} for the stored chunks among `ids`
+        db = self.store()
+        ids = list(ids)
+        found = {}
+        for i in range(0, len(ids), 500):
+            part = ids[i:i + 500]
+            found.update(
+                (chunk_id, np.frombuffer(blob, dtype=np.uint32))
+                for chunk_id, blob in db.execute(
+                    "select id, signature from fingerprints"
+                    f" where id in ({','.join('?' * len(part))})",
+                    part
+                )
+            )
+        return found
+
+    def duplicates(self):
+        # -> iterator of (duplicate chunk id, canonical chunk id, source tag)
+        return self.store().execute("select id, canonical, tag from duplicates")
+
+    def chunk_counts(self):
+        # -> {file name: 1 + the highest chunk number recorded for it}
+        counts = {}
+        for (chunk_id,) in self.store().execute(
+            "select id from fingerprints union all select id from duplicates"
+        ):
+            name, _, j = chunk_id.rpartition("_")
+            if j.isdigit():
+                counts[name] = max(counts.get(name, 0), int(j) + 1)
+        return counts
+
+    def orphans(self):
+        # Duplicates whose canonical chunk is gone. -> {file name: [chunk ids]}
+        files = {}
+        for (chunk_id,) in self.store().execute(
+            "select id from duplicates where canonical not in (select id from fingerprints)"
+        ):
+            files.setdefault(chunk_id.rpartition("_")[0], []).append(chunk_id)
+        return files
+
+    def also_in(self, canonical):
+        return "; ".join(r[0] for r in self.store().execute(
+            "select distinct tag from duplicates where canonical = ? order by tag",
+            (canonical,)
+        ))
+
+    def commit(self):
+        self.store().commit()
+
+dedup_index = DedupIndex(DEDUP_STORE_PATH)
+
+def update_also_in(collection, canonicals):
+    ids = sorted(dedup_index.known(canonicals))
+    if ids:
+        collection.update(
+            ids=ids, metadatas=[{"also_in": dedup_index.also_in(c)} for c in ids]
+        )
+
+def backfill_dedup_index(collection, page_size=1000):
+    # Collections built before deduplication: fingerprint what is stored and,
+    # with DEDUP_CHUNKS on, remove the near-duplicates already in there
+    offset = 0
+    removed = []
+    canonicals = set()
+    while True:
+        page = collection.get(
+            include=["documents", "metadatas"], limit=page_size, offset=offset
+        )
+        if not page["ids"]:
+            break
+        for chunk_id, document, metadata in zip(
+            page["ids"], page["documents"], page["metadatas"]
+        ):
+            signature = dedup_index.signature(document)
+            match = dedup_index.find(signature) if DEDUP_CHUNKS else None
+            if match:
+                dedup_index.add_duplicate(chunk_id, match[0], source_tag(chunk_id, metadata))
+                removed.append(chunk_id)
+                canonicals.add(match[0])
+            else:
+                dedup_index.add(chunk_id, signature)
+        offset += len(page["ids"])
+
+    if removed:
+        collection.delete(ids=removed)
+        lexical_index.delete(removed)
+        update_also_in(collection, canonicals)
+        collection_changed()
+    dedup_index.commit()
+    print(f"Dedup index backfilled with {offset} chunks, {len(removed)} near-duplicates removed.")
 
 # ---------- DOCUMENT READERS ----------
 
-def read_pdf(path):
-    text = ""
+def read_pdf_pages(path):
+    import pdfplumber
     with pdfplumber.open(path) as pdf:
         for page in pdf.pages:
-            t = page.extract_text()
-            if t:
-                text += t + "\n"
-    return text
+            yield page.extract_text() or ""
+            page.close()
 
 def read_docx(path):
+    import docx
     doc = docx.Document(path)
     return "\n".join(p.text for p in doc.paragraphs if p.text.strip())
 
+# ---------- PARALLEL EXTRACTION ----------
+
+# Workers write a document's chunks to a JSONL spool file, one line each, and
+# only hand back its path: neither the worker nor the pool's result pipe nor
+# ingest ever holds the full chunk list of a thousand-page book.
+
+def extract_document(path, spool_dir=None):
+    # Runs in a worker process: never raise, report the error instead so one
+    # corrupt file cannot take the batch down with it.
+    path = Path(path)
+    fd, spool = tempfile.mkstemp(prefix=path.stem + ".", suffix=".jsonl", dir=spool_dir)
+    try:
+        n_pages = n_chunks = 0
+        with os.fdopen(fd, "w", encoding="utf-8") as out:
+            if path.suffix.lower() == ".pdf":
+                def pdf_pages():
+                    nonlocal n_pages
+                    for t in read_pdf_pages(path):
+                        n_pages += 1
+                        yield t
+                pages = pdf_pages()
+            else:
+                n_pages = 1
+                pages = [read_docx(path)]
+            for text, metadata in chunk_pages(pages):
+                metadata["source"] = path.name
+                out.write(json.dumps([text, metadata]) + "\n")
+                n_chunks += 1
+        return path.name, spool, n_chunks, n_pages, None
+    except Exception as e:
+        os.remove(spool)
+        return path.name, None, 0, 0, f"{type(e).__name__}: {e}"
+
+def read_spool(spool, skip=0):
+    # Streams the (text, metadata) chunks of a spool file, from chunk `skip`
+    try:
+        with open(spool, encoding="utf-8") as f:
+            for j, line in enumerate(f):
+                if j >= skip:
+                    text, metadata = json.loads(line)
+                    yield text, metadata
+    finally:
+        os.remove(spool)
+
+def extract_documents(files, workers=EXTRACT_WORKERS, timeout=EXTRACT_TIMEOUT):
+    # Yields (file, spool, chunks, pages, error) in completion order; the
+    # caller reads the spool with read_spool() before taking the next result.
+    # A new file is only handed to the pool once the caller has taken a
+    # result, so at most `workers` spool files exist at a time.
+    by_name = {file.name: file for file in files}
+    # Removed with whatever spools are left of failed or abandoned files
+    spool_dir = tempfile.mkdtemp(prefix="ingest-")
+    try:
+        if workers <= 1 or len(files) <= 1:
+            for file in files:
+                name, spool, chunks, pages, error = extract_document(file, spool_dir)
+                yield by_name[name], spool, chunks, pages, error
+            return
+
+        pending = list(files)
+        done = queue.Queue()
+
+        while pending:
+            # At most `workers` files in flight, so a file's deadline starts
+            # roughly when a worker picks it up.
+            # spawn, not fork: ingest now runs next to the server's threads, and
+            # importing this module in a fresh worker is cheap
+            pool = multiprocessing.get_context("spawn").Pool(
+                workers, maxtasksperchild=20
+            )
+            in_flight = {}
+            restart = False
+
+            def submit():
+                file = pending.pop(0)
+                in_flight[file.name] = time.monotonic()
+                pool.apply_async(
+                    extract_document, (str(file), spool_dir), callback=done.put
+                )
+
+            try:
+                while pending and len(in_flight) < workers:
+                    submit()
+
+                while in_flight:
+                    try:
+                        name, spool, chunks, pages, error = done.get(timeout=1.0)
+                    except queue.Empty:
+                        now = time.monotonic()
+                        expired = [n for n, t in in_flight.items() if now - t > timeout]
+                        if not expired:
+                            continue
+                        # A worker is stuck (or died): give up on those files and
+                        # restart the pool for the rest.
+                        for n in expired:
+                            del in_flight[n]
+                            yield by_name[n], None, 0, 0, f"timed out after {timeout:.0f}s"
+                        pending[:0] = [by_name[n] for n in in_flight]
+                        restart = True
+                        break
+
+                    if name not in in_flight:
+                        continue  # late result from a file we already gave up on
+                    del in_flight[name]
+                    yield by_name[name], spool, chunks, pages, error
+
+                    if pending:
+                        submit()
+            finally:
+                if restart:
+                    pool.terminate()
+                else:
+                    pool.close()
+                pool.join()
+    finally:
+        shutil.rmtree(spool_dir, ignore_errors=True)
+
 # ---------- CHUNKING ----------
 
-def chunk_text(text, size=800):
-    words = text.split()
-    return [
-        " ".join(words[i:i+size])
-        for i in range(0, len(words), size)
-    ]
+# Chunks are measured in the embedding model's own word pieces so that all of
+# a chunk is actually embedded (MiniLM truncates at 256). Pages are cut into
+# sentences inside paragraphs; a chunk is filled with whole sentences up to
+# CHUNK_TOKENS and the next one starts with the last CHUNK_OVERLAP_TOKENS
+# worth of sentences. Only a sentence longer than a whole chunk is cut
+# mid-sentence, at word-piece boundaries.
+
+PARAGRAPH = re.compile(r"\S(?:.*?\S)?(?=\n[ \t]*\n|\s*\Z)", re.S)
+SENTENCE = re.compile(r"\S.*?(?:[.!?][\"'\u201d\u2019)\]]*(?=\s)|\Z)", re.S)
+
+def split_units(page_no, page, max_tokens):
+    # -> [(page, paragraph, start, end, text, n_tokens)], offsets into `page`
+    spans = []
+    for p, para in enumerate(PARAGRAPH.finditer(page)):
+        for sent in SENTENCE.finditer(para.group()):
+            start = para.start() + sent.start()
+            spans.append((p, start, start + len(sent.group())))
+    if not spans:
+        return []
+
+    tokenizer = get_tokenizer()
+    encoded = tokenizer(
+        [" ".join(page[a:b].split()) for _, a, b in spans],
+        add_special_tokens=False
+    )["input_ids"]
+
+    units = []
+    for (p, start, end), ids in zip(spans, encoded):
+        if len(ids) <= max_tokens:
+            units.append((page_no, p, start, end, " ".join(page[start:end].split()), len(ids)))
+            continue
+        # Oversized sentence: cut it every max_tokens word pieces
+        offsets = tokenizer(
+            page[start:end], add_special_tokens=False, return_offsets_mapping=True
+        )["offset_mapping"]
+        for i in range(0, len(offsets), max_tokens):
+            a = start + offsets[i][0]
+            b = start + offsets[min(i + max_tokens, len(offsets)) - 1][1]
+            piece = offsets[i:i + max_tokens]
+            units.append((page_no, p, a, b, " ".join(page[a:b].split()), len(piece)))
+    return units
+
+def make_chunk(window, n_tokens):
+    parts = []
+    for i, unit in enumerate(window):
+        if i:
+            same_paragraph = unit[:2] == window[i - 1][:2]
+            parts.append(" " if same_paragraph else "\n\n")
+        parts.append(unit[4])
+    metadata = {
+        "page_start": window[0][0],
+        "page_end": window[-1][0],
+        "char_start": window[0][2],
+        "char_end": window[-1][3],
+        "tokens": n_tokens,
+    }
+    return "".join(parts), metadata
+
+def chunk_pages(pages, max_tokens=CHUNK_TOKENS, overlap=CHUNK_OVERLAP_TOKENS):
+    # Streams (text, metadata) chunks out of an iterable of page texts
+    window = []
+    size = 0
+    for page_no, page in enumerate(pages, 1):
+        for unit in split_units(page_no, page, max_tokens):
+            if window and size + unit[5] > max_tokens:
+                yield make_chunk(window, size)
+                # Carry the tail over as overlap, as long as the new unit fits
+                keep = []
+                kept = 0
+                for u in reversed(window):
+                    if kept + u[5] > overlap or kept + u[5] + unit[5] > max_tokens:
+                        break
+                    keep.insert(0, u)
+                    kept += u[5]
+                window, size = keep, kept
+            window.append(unit)
+            size += unit[5]
+    if window:
+        yield make_chunk(window, size)
+
+# ---------- INGEST MANIFEST ----------
+
+# The manifest maps every ingested file name to the sha256 of its content and
+# the number of chunks stored for it, so a restart only has to touch files that
+# were added, changed or removed since the last ingest.
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def manifest_stamp(path=MANIFEST_PATH):
+    # Changes whenever save_manifest() replaces the file, in any process
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+def load_manifest():
+    if not os.path.exists(MANIFEST_PATH):
+        return {}
+    with open(MANIFEST_PATH, encoding="utf-8") as f:
+        return json.load(f)
+
+def save_manifest(manifest):
+    os.makedirs(DB_PATH, exist_ok=True)
+    tmp = MANIFEST_PATH + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, MANIFEST_PATH)
+
+def chunk_ids(name, start, stop):
+    return [f"{name}_{j}" for j in range(start, stop)]
+
+def stored_chunks(entry):
+    # Upper bound on the chunk IDs of a file that may exist in the collection.
+    # An interrupted re-ingest can leave "stale" tail chunks of the previous
+    # version behind the ones already rewritten.
+    return max(entry["chunks"], entry.get("stale", 0))
+
+def list_documents():
+    folder = Path(DOCS_FOLDER)
+    if not folder.is_dir():
+        return []
+    return sorted(
+        f for f in folder.iterdir()
+        if f.is_file() and f.suffix.lower() in SUPPORTED_SUFFIXES
+    )
+
+def adopt_existing_collection():
+    # Databases built before the manifest existed: record which chunks each
+    # file has stored so the next pass can replace or delete them. Entries carry
+    # no chunker version, so files are re-chunked only if the chunker changed.
+    counts = {}
+    for chunk_id in get_collection().get(include=[])["ids"]:
+        name, _, j = chunk_id.rpartition("_")
+        counts[name] = max(counts.get(name, 0), int(j) + 1)
+
+    manifest = {}
+    for file in list_documents():
+        if file.name in counts:
+            manifest[file.name] = {
+                "sha256": file_sha256(file),
+                "chunks": counts.pop(file.name),
+            }
+    # Chunks whose source file is gone are kept in the manifest so the next
+    # pass deletes them.
+    for name, n in counts.items():
+        manifest[name] = {"sha256": None, "chunks": n}
+
+    print(f"Adopted existing collection: {len(manifest)} files.")
+    return manifest
 
 # ---------- INGEST DOCUMENTS ----------
 
+# Ingest is a stream: extracted files yield chunks, chunks are grouped into
+# EMBED_BATCH_SIZE batches (across file boundaries), and every batch is
+# embedded and written to Chroma before the next one is built. After each
+# batch the manifest records how many chunks of each file are stored, marked
+# "complete": false until the file's last chunk is written, so an interrupted
+# ingest resumes from the last written batch instead of starting over.
+# Chunks that are near-duplicates of a stored one keep their position (and
+# chunk ID) in the manifest but are only recorded in dedup_index.
+
 def ingest_documents():
 
+    collection = get_collection()
+    if (
+        SNAPSHOT_PATH
+        and collection.count() == 0
+        and os.path.exists(os.path.join(SNAPSHOT_PATH, "snapshot.json"))
+    ):
+        import_snapshot(SNAPSHOT_PATH)
+
+    manifest = load_manifest()
+    if not manifest and collection.count() > 0:
+        manifest = adopt_existing_collection()
+        save_manifest(manifest)
+
+    if lexical_index.count() == 0 and collection.count() > 0:
+        backfill_lexical_index(collection)
+    if dedup_index.count() == 0 and collection.count() > 0:
+        backfill_dedup_index(collection)
+
+    files = list_documents()
+    present = {file.name for file in files}
+
+    removed = unchanged = 0
+    # Chunk IDs of previous file versions that may still be in the collection
+    stale_ids = set()
+    # Canonical chunks whose "also_in" metadata needs rewriting
+    refresh = set()
+
+    def drop_chunks(ids):
+        stored, touched = dedup_index.drop(ids)
+        refresh.update(touched)
+        return stored
+
+    # Signatures are recorded as chunks are read, before their batch reaches
+    # the collection and the manifest. After a failed flush or a crash
+    # between dedup_index.commit() and save_manifest() the index can know of
+    # chunks the manifest does not, and a re-read file would match them: its
+    # own chunks would be skipped as duplicates of themselves. Everything the
+    # index holds for a file is dropped before the file is read again.
+    recorded = dedup_index.chunk_counts()
+
+    def chunk_bound(name, entry):
+        # Upper bound on the chunk IDs earlier runs may have left for `name`
+        return max(stored_chunks(entry) if entry else 0, recorded.get(name, 0))
+
+    # Files removed from ./docs
+    for name in sorted(set(manifest) - present):
+        n = chunk_bound(name, manifest[name])
+        if n:
+            ids = drop_chunks(chunk_ids(name, 0, n))
+            if ids:
+                collection.delete(ids=ids)
+                lexical_index.delete(ids)
+            collection_changed()
+        del manifest[name]
+        save_manifest(manifest)
+        removed += 1
+        print(f"Removed file: {name} ({n} chunks)")
+
+    todo = {}
+    for file in files:
+        digest = file_sha256(file)
+        entry = manifest.get(file.name)
+
+        if (
+            entry
+            and entry["sha256"] == digest
+            and entry.get("chunker") == CHUNKER_VERSION
+        ):
+            if entry.get("complete", True):
+                unchanged += 1
+                continue
+            # Same content, interrupted last time: keep what was written
+            skip, kind = entry["chunks"], "resumed"
+        else:
+            skip, kind = 0, "changed" if entry else "added"
+        stale = chunk_bound(file.name, entry)
+        todo[file.name] = (kind, digest, stale, skip)
+        stale_ids.update(drop_chunks(chunk_ids(file.name, skip, stale)))
+
+    # Duplicates whose canonical chunk went away with its file: read their
+    # files again so the passage is stored under one of them
+    while orphans := dedup_index.orphans():
+        for name, ids in orphans.items():
+            entry = manifest.get(name)
+            if name in present and entry:
+                if name not in todo:
+                    unchanged -= 1
+                stale = chunk_bound(name, entry)
+                todo[name] = ("requeued", entry["sha256"], stale, 0)
+                stale_ids.update(drop_chunks(chunk_ids(name, 0, stale)))
+            else:
+                drop_chunks(ids)
+
+    files = [file for file in files if file.name in todo]
+    counts = {
+        "added": 0, "changed": 0, "resumed": 0, "requeued": 0, "failed": 0,
+        "files": 0, "pages": 0, "chunks": 0, "duplicates": 0,
+    }
+    start = time.monotonic()
+
+    def chunk_stream():
+        for file, spool, n_chunks, pages, error in extract_documents(files):
+            if error:
+                # Leave the manifest alone so the file is retried on the next run
+                print(f"Failed to read {file.name}: {error}")
+                counts["failed"] += 1
+                continue
+
+            print(f"Processing file: {file.name} ({pages} pages, {n_chunks} chunks)")
+            counts["files"] += 1
+            counts["pages"] += pages
+
+            kind, digest, stale, skip = todo[file.name]
+            counts[kind] += 1
+            manifest[file.name] = {
+                "sha256": digest,
+                "chunker": CHUNKER_VERSION,
+                "chunks": skip,
+                "complete": False,
+                "stale": stale,
+            }
+
+            for j, chunk in enumerate(read_spool(spool, skip), skip):
+                yield file.name, j, chunk
+            # End-of-file marker, handled once all of its chunks are flushed
+            yield file.name, None, n_chunks
+
+    finished = []
+
+    def finish_files():
+        for name, total in finished:
+            entry = manifest[name]
+            if entry["stale"] > total:
+                # The file shrank: drop the tail chunks of the previous version
+                ids = [i for i in chunk_ids(name, total, entry["stale"]) if i in stale_ids]
+                if ids:
+                    collection.delete(ids=ids)
+                    lexical_index.delete(ids)
+                collection_changed()
+            manifest[name] = {
+                "sha256": entry["sha256"],
+                "chunker": entry["chunker"],
+                "chunks": total,
+            }
+        finished.clear()
+
+    batch = []
+
+    def flush():
+        if batch:
+            kept = [(name, j, chunk) for name, j, chunk, canonical in batch if not canonical]
+            if kept:
+                documents = [chunk for _, _, (chunk, _) in kept]
+                embeddings = embedding_cache.encode(
+                    documents, batch_size=EMBED_BATCH_SIZE
+                ).tolist()
+                ids = [f"{name}_{j}" for name, j, _ in kept]
+                collection.upsert(
+                    documents=documents,
+                    embeddings=embeddings,
+                    metadatas=[metadata for _, _, (_, metadata) in kept],
+                    ids=ids
+                )
+                lexical_index.add(ids, documents)
+            # A duplicate may sit where the previous version stored a chunk
+            replaced = [
+                f"{name}_{j}" for name, j, _, canonical in batch
+                if canonical and f"{name}_{j}" in stale_ids
+            ]
+            if replaced:
+                collection.delete(ids=replaced)
+                lexical_index.delete(replaced)
+            collection_changed()
+            for name, j, _, _ in batch:
+                manifest[name]["chunks"] = j + 1
+            counts["chunks"] += len(kept)
+            counts["duplicates"] += len(batch) - len(kept)
+            batch.clear()
+        update_also_in(collection, refresh)
+        refresh.clear()
+        dedup_index.commit()
+        finish_files()
+        save_manifest(manifest)
+
+    for name, j, chunk in chunk_stream():
+        if j is None:
+            finished.append((name, chunk))
+            continue
+        chunk_id = f"{name}_{j}"
+        signature = dedup_index.signature(chunk[0])
+        match = dedup_index.find(signature) if DEDUP_CHUNKS else None
+        if match:
+            dedup_index.add_duplicate(chunk_id, match[0], source_tag(chunk_id, chunk[1]))
+            refresh.add(match[0])
+        else:
+            dedup_index.add(chunk_id, signature)
+        batch.append((name, j, chunk, match and match[0]))
+        if len(batch) == EMBED_BATCH_SIZE:
+            flush()
+    flush()
+
+    if lexical_index.dirty or not os.path.exists(LEXICAL_INDEX_PATH):
+        lexical_index.compile()
+
+    ingest_exemplars()
+
+    elapsed = time.monotonic() - start
+    if counts["files"]:
+        print(
+            f"Read {counts['files']} files / {counts['pages']} pages / "
+            f"{counts['chunks']} chunks in {elapsed:.1f}s "
+            f"({counts['files'] / elapsed:.2f} files/sec, "
+            f"{counts['pages'] / elapsed:.1f} pages/sec)"
+        )
+
+    print(
+        f"Ingestion complete: {counts['added']} added, "
+        f"{counts['changed']} changed, {counts['resumed']} resumed, "
+        f"{removed} removed, {unchanged} unchanged, {counts['failed']} failed."
+    )
+    dedup = dedup_index.stats()
+    print(
+        f"Dedup: {counts['duplicates']} near-duplicate chunks skipped, "
+        f"{counts['requeued']} files re-read for lost duplicates; the index holds "
+        f"{dedup['chunks']} chunks for {dedup['chunks'] + dedup['duplicates']} "
+        f"({dedup['shrink']:.1%} smaller)."
+    )
+    cache = embedding_cache.stats()
+    print(
+        f"Embedding cache: {cache['hits']} hits, {cache['misses']} misses "
+        f"({cache['hit_rate']:.1%} hit rate), {cache['entries']} vectors, "
+        f"{cache['bytes'] / 2**20:.1f} MB."
+    )
+
+# ---------- SNAPSHOTS ----------
+
+# A fresh professor_db volume used to mean a full ingest before the API was
+# ready. A snapshot is the built index in a portable, versioned form:
+#   chunks.jsonl    one {"id", "document", "metadata"} per chunk
+#   embeddings.npy  float16, one row per chunks.jsonl line
+#   signatures.npy  the chunks' MinHash signatures for dedup_index
+#   snapshot.json   format version, model, chunker, sha256 of the files
+#                   above, the ingest manifest and the recorded duplicates
+# `export-snapshot DIR` writes one from the current database, and
+# `import-snapshot DIR` bulk-loads it into an empty one in
+# SNAPSHOT_BATCH_SIZE batches. With SNAPSHOT_PATH set, ingest does the import
+# itself when it finds the collection empty, so a snapshot baked into the
+# image or volume makes the first boot independent of corpus size. The ingest
+# manifest comes along, so ingest then only touches files that differ from
+# the snapshot's.
+
+SNAPSHOT_VERSION = 1
+SNAPSHOT_BATCH_SIZE = 5000
+SNAPSHOT_FILES = ("chunks.jsonl", "embeddings.npy", "signatures.npy")
+
+def export_snapshot(target, page_size=SNAPSHOT_BATCH_SIZE):
+    collection = get_collection()
+    count = collection.count()
+    if count == 0:
+        raise ValueError("the collection is empty: nothing to export")
+    dedup_index.store()
+
+    start = time.monotonic()
+    target = os.path.normpath(target)
+    tmp = target + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    embeddings = signatures = None
+    offset = 0
+    with open(os.path.join(tmp, "chunks.jsonl"), "w", encoding="utf-8") as f:
+        while True:
+            page = collection.get(
+                include=["documents", "metadatas", "embeddings"],
+                limit=page_size, offset=offset
+            )
+            if not page["ids"]:
+                break
+            vectors = np.asarray(page["embeddings"], dtype=np.float16)
+            if embeddings is None:
+                embeddings = np.lib.format.open_memmap(
+                    os.path.join(tmp, "embeddings.npy"), mode="w+",
+                    dtype=np.float16, shape=(count, vectors.shape[1])
+                )
+                signatures = np.lib.format.open_memmap(
+                    os.path.join(tmp, "signatures.npy"), mode="w+",
+                    dtype=np.uint32, shape=(count, DEDUP_PERMUTATIONS)
+                )
+            n = len(page["ids"])
+            if offset + n > count:
+                raise RuntimeError("the collection changed during export")
+            embeddings[offset:offset + n] = vectors
+            known = dedup_index.signatures(page["ids"])
+            for i, (chunk_id, document, metadata) in enumerate(
+                zip(page["ids"], page["documents"], page["metadatas"])
+            ):
+                signature = known.get(chunk_id)
+                if signature is None:
+                    signature = dedup_index.signature(document)
+                signatures[offset + i] = signature
+                f.write(json.dumps(
+                    {"id": chunk_id, "document": document, "metadata": metadata},
+                    ensure_ascii=False
+                ) + "\n")
+            offset += n
+    if offset != count:
+        raise RuntimeError("the collection changed during export")
+    dim = embeddings.shape[1]
+    embeddings.flush()
+    signatures.flush()
+    del embeddings, signatures
+
+    meta = {
+        "version": SNAPSHOT_VERSION,
+        "created": time.time(),
+        "model": EMBED_MODEL_NAME,
+        "chunker": CHUNKER_VERSION,
+        "chunks": count,
+        "dim": dim,
+        "sha256": {name: file_sha256(os.path.join(tmp, name)) for name in SNAPSHOT_FILES},
+        "manifest": load_manifest(),
+        "duplicates": {
+            chunk_id: [canonical, tag]
+            for chunk_id, canonical, tag in dedup_index.duplicates()
+        },
+    }
+    with open(os.path.join(tmp, "snapshot.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=1)
+
+    old = target + ".old"
+    shutil.rmtree(old, ignore_errors=True)
+    if os.path.exists(target):
+        os.replace(target, old)
+    os.replace(tmp, target)
+    shutil.rmtree(old, ignore_errors=True)
+    size = sum(os.path.getsize(os.path.join(target, name)) for name in os.listdir(target))
+    print(
+        f"Snapshot exported to {target}: {count} chunks, {size / 2**20:.1f} MB "
+        f"in {time.monotonic() - start:.1f}s"
+    )
+
+def import_snapshot(source, batch_size=SNAPSHOT_BATCH_SIZE):
+    start = time.monotonic()
+    with open(os.path.join(source, "snapshot.json"), encoding="utf-8") as f:
+        meta = json.load(f)
+    if meta.get("version") != SNAPSHOT_VERSION:
+        raise ValueError(
+            f"snapshot format {meta.get('version')} is not supported (expected {SNAPSHOT_VERSION})"
+        )
+    if meta["model"] != EMBED_MODEL_NAME:
+        raise ValueError(f"snapshot was built with {meta['model']}, not {EMBED_MODEL_NAME}")
+    for name in SNAPSHOT_FILES:
+        if file_sha256(os.path.join(source, name)) != meta["sha256"][name]:
+            raise ValueError(f"snapshot file {name} does not match its checksum")
+
+    collection = get_collection()
     if collection.count() > 0:
-        print("Database already populated.")
+        raise ValueError("the collection is not empty: import needs a fresh database")
+    if meta["chunker"] != CHUNKER_VERSION:
+        print(
+            f"Snapshot chunker {meta['chunker']} differs from {CHUNKER_VERSION}: "
+            "its files will be re-chunked by the next ingest"
+        )
+
+    # Until the import is done the manifest marks every file as interrupted
+    # at chunk 0, so a crashed import is finished by the usual resume path
+    manifest = meta["manifest"]
+    save_manifest({
+        name: {**entry, "chunks": 0, "complete": False, "stale": stored_chunks(entry)}
+        for name, entry in manifest.items()
+    })
+
+    embeddings = np.load(os.path.join(source, "embeddings.npy"), mmap_mode="r")
+    signatures = np.load(os.path.join(source, "signatures.npy"), mmap_mode="r")
+    if len(embeddings) != meta["chunks"] or len(signatures) != meta["chunks"]:
+        raise ValueError("snapshot arrays do not match its chunk count")
+
+    offset = 0
+    batch = []
+
+    def load():
+        nonlocal offset
+        ids = [row["id"] for row in batch]
+        documents = [row["document"] for row in batch]
+        collection.add(
+            ids=ids,
+            documents=documents,
+            metadatas=[row["metadata"] for row in batch],
+            embeddings=np.asarray(embeddings[offset:offset + len(batch)], dtype=np.float32)
+        )
+        lexical_index.add(ids, documents)
+        for i, chunk_id in enumerate(ids):
+            dedup_index.add(chunk_id, np.array(signatures[offset + i]))
+        offset += len(batch)
+        batch.clear()
+
+    with open(os.path.join(source, "chunks.jsonl"), encoding="utf-8") as f:
+        for line in f:
+            batch.append(json.loads(line))
+            if len(batch) == batch_size:
+                load()
+    if batch:
+        load()
+    if offset != meta["chunks"]:
+        raise ValueError("snapshot chunks.jsonl does not match its chunk count")
+
+    for chunk_id, (canonical, tag) in meta["duplicates"].items():
+        dedup_index.add_duplicate(chunk_id, canonical, tag)
+    dedup_index.commit()
+    lexical_index.compile()
+    collection_changed()
+    save_manifest(manifest)
+    print(
+        f"Snapshot imported from {source}: {offset} chunks, {len(manifest)} files "
+        f"in {time.monotonic() - start:.1f}s"
+    )
+
+# ---------- QUERY CACHES ----------
+
+# Two levels: the query embedding (CPU encode) is memoized on the normalized
+# question text, and the Chroma top-k result is kept for RETRIEVAL_CACHE_TTL
+# seconds. Ingest clears the second level whenever it writes to the collection,
+# and it is also dropped whenever the ingest or exemplar manifest on disk
+# changes, so an ingest by another process is picked up on the next query.
+
+OVERRIDE_MARKER = "[SYSTEM CONTEXT OVERRIDE]"
+
+def normalize_question(question):
+    # Older gateways wrap every prompt in the same configuration boilerplate:
+    # only the user's own text is worth embedding.
+    if OVERRIDE_MARKER in question and "USER INPUT:" in question:
+        question = question.split("USER INPUT:", 1)[1]
+    # all-MiniLM-L6-v2 is uncased, so case and spacing never change the vector
+    return " ".join(question.lower().split())
+
+class TTLCache:
+
+    def __init__(self, maxsize, ttl, version=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # Everything is dropped whenever version() returns something new
+        self.version = version
+        self.current = None
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def check_version(self):
+        if self.version is not None:
+            current = self.version()
+            if current != self.current:
+                self.items.clear()
+                self.current = current
+
+    def get(self, key):
+        with self.lock:
+            self.check_version()
+            item = self.items.get(key)
+            if item and time.monotonic() - item[0] < self.ttl:
+                self.items.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            if item:
+                del self.items[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.check_version()
+            self.items[key] = (time.monotonic(), value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size": len(self.items),
+        }
+
+# ---------- QUERY EMBEDDING BATCHER ----------
+
+# Encoding one question at a time wastes most of a forward pass on overhead,
+# and concurrent requests end up fighting over the same cores. Request threads
+# instead hand their text to a single batching thread, which waits up to
+# QUERY_BATCH_MAX_WAIT for others to arrive (or QUERY_BATCH_MAX_SIZE texts),
+# encodes them together and resolves every waiter's future.
+
+class EmbeddingBatcher:
+
+    def __init__(self, max_size, max_wait):
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.items = 0
+        self.max_batch = 0
+        self.batch_sizes = {}
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.encode_total = 0.0
+        self.encode_max = 0.0
+
+    def encode(self, text):
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(
+                        target=self.run, name="query-embedder", daemon=True
+                    )
+                    self.thread.start()
+        future = concurrent.futures.Future()
+        self.queue.put((text, time.monotonic(), future))
+        return future.result()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            texts = list(dict.fromkeys(text for text, _, _ in batch))
+            start = time.monotonic()
+            try:
+                vectors = get_embed_model().encode(texts, batch_size=len(texts))
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            done = time.monotonic()
+
+            rows = {text: tuple(v.tolist()) for text, v in zip(texts, vectors)}
+            for text, _, future in batch:
+                future.set_result(rows[text])
+            self.record(batch, start, done)
+
+    def record(self, batch, start, done):
+        QUERY_BATCH_SIZES.observe(len(batch))
+        for _, queued, _ in batch:
+            QUERY_BATCH_WAIT_SECONDS.observe(start - queued)
+        with self.lock:
+            self.batches += 1
+            self.items += len(batch)
+            self.max_batch = max(self.max_batch, len(batch))
+            self.batch_sizes[len(batch)] = self.batch_sizes.get(len(batch), 0) + 1
+            for _, queued, _ in batch:
+                self.wait_total += start - queued
+                self.wait_max = max(self.wait_max, start - queued)
+            self.encode_total += done - start
+            self.encode_max = max(self.encode_max, done - start)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "batches": self.batches,
+                "items": self.items,
+                "mean_batch_size": self.items / self.batches if self.batches else 0.0,
+                "max_batch_size": self.max_batch,
+                "batch_sizes": dict(sorted(self.batch_sizes.items())),
+                "mean_queue_wait_ms": 1000 * self.wait_total / self.items if self.items else 0.0,
+                "max_queue_wait_ms": 1000 * self.wait_max,
+                "mean_encode_ms": 1000 * self.encode_total / self.batches if self.batches else 0.0,
+                "max_encode_ms": 1000 * self.encode_max,
+            }
+
+query_batcher = EmbeddingBatcher(QUERY_BATCH_MAX_SIZE, QUERY_BATCH_MAX_WAIT)
+
+@functools.lru_cache(maxsize=QUERY_EMBED_CACHE_SIZE)
+def embed_query(text):
+    return query_batcher.encode(text)
+
+def retrieval_version():
+    # An ingest in another process (`reindex`, another worker) only shows
+    # in the manifests it rewrites
+    return manifest_stamp(), manifest_stamp(EXEMPLAR_MANIFEST_PATH)
+
+retrieval_cache = TTLCache(RETRIEVAL_CACHE_SIZE, RETRIEVAL_CACHE_TTL, retrieval_version)
+
+def collection_changed():
+    retrieval_cache.clear()
+
+def cache_stats():
+    info = embed_query.cache_info()
+    lookups = info.hits + info.misses
+    return {
+        "query_embeddings": {
+            "hits": info.hits,
+            "misses": info.misses,
+            "hit_rate": info.hits / lookups if lookups else 0.0,
+            "size": info.currsize,
+        },
+        "retrieval": retrieval_cache.stats(),
+        "answers": get_answer_cache().stats() if ANSWER_CACHE else None,
+    }
+
+# ---------- ANSWER CACHE ----------
+
+# Workshop groups keep asking the same questions. When ANSWER_CACHE=1, every
+# answer is stored in SQLite next to the question's embedding, and a later
+# question in the same format and era whose embedding has cosine similarity
+# >= ANSWER_CACHE_THRESHOLD gets the stored answer back without calling Claude.
+# Entries expire after ANSWER_CACHE_TTL seconds and the least recently used
+# ones are evicted beyond ANSWER_CACHE_MAX_ENTRIES. The embeddings are also
+# kept in memory so a lookup is a single matrix product.
+
+class AnswerCache:
+
+    def __init__(self, path, threshold, max_entries, ttl):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "create table if not exists answers ("
+            " id integer primary key,"
+            " key text not null,"
+            " embedding blob not null,"
+            " question text not null,"
+            " answer text not null,"
+            " created real not null,"
+            " last_used real not null)"
+        )
+        self.db.execute(
+            "delete from answers where created < ?", (time.time() - ttl,)
+        )
+        self.db.commit()
+
+        rows = self.db.execute("select id, key, embedding from answers").fetchall()
+        self.ids = [r[0] for r in rows]
+        self.keys = [r[1] for r in rows]
+        self.vectors = [np.frombuffer(r[2], dtype=np.float32) for r in rows]
+        self.matrix = None
+
+    def _matrix(self):
+        if self.matrix is None:
+            self.matrix = np.stack(self.vectors) if self.vectors else None
+        return self.matrix
+
+    def _forget(self, row_ids):
+        row_ids = set(row_ids)
+        keep = [i for i, row_id in enumerate(self.ids) if row_id not in row_ids]
+        self.ids = [self.ids[i] for i in keep]
+        self.keys = [self.keys[i] for i in keep]
+        self.vectors = [self.vectors[i] for i in keep]
+        self.matrix = None
+
+    def lookup(self, key, embedding):
+        # -> (answer, similarity) or None
+        with self.lock:
+            matrix = self._matrix()
+            if matrix is not None:
+                scores = matrix @ embedding
+                scores[np.array(self.keys) != key] = -1.0
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    row = self.db.execute(
+                        "select answer, created from answers where id = ?",
+                        (self.ids[best],)
+                    ).fetchone()
+                    if row and time.time() - row[1] < self.ttl:
+                        self.db.execute(
+                            "update answers set last_used = ? where id = ?",
+                            (time.time(), self.ids[best])
+                        )
+                        self.db.commit()
+                        self.hits += 1
+                        return row[0], min(float(scores[best]), 1.0)
+                    # Expired: drop it so it stops matching
+                    self.db.execute(
+                        "delete from answers where id = ?", (self.ids[best],)
+                    )
+                    self.db.commit()
+                    self._forget([self.ids[best]])
+            self.misses += 1
+            return None
+
+    def store(self, key, embedding, question, answer):
+        with self.lock:
+            now = time.time()
+            cur = self.db.execute(
+                "insert into answers"
+                " (key, embedding, question, answer, created, last_used)"
+                " values (?, ?, ?, ?, ?, ?)",
+                (key, embedding.tobytes(), question, answer, now, now)
+            )
+            self.ids.append(cur.lastrowid)
+            self.keys.append(key)
+            self.vectors.append(embedding)
+            self.matrix = None
+
+            excess = len(self.ids) - self.max_entries
+            if excess > 0:
+                evicted = [r[0] for r in self.db.execute(
+                    "select id from answers order by last_used limit ?", (excess,)
+                )]
+                self.db.executemany(
+                    "delete from answers where id = ?", [(i,) for i in evicted]
+                )
+                self._forget(evicted)
+            self.db.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size": len(self.ids),
+        }
+
+def get_answer_cache():
+    # Opened on first use, so each worker has its own connection
+    def make():
+        if not ANSWER_CACHE:
+            return None
+        return AnswerCache(
+            ANSWER_CACHE_PATH,
+            ANSWER_CACHE_THRESHOLD,
+            ANSWER_CACHE_MAX_ENTRIES,
+            ANSWER_CACHE_TTL
+        )
+    return lazy("answer_cache", make)
+
+def answer_cache_key(question, response_format, phase):
+    key = f"{format_key(response_format) or ''}/{era_key(phase) or ''}"
+    vector = np.array(embed_query(normalize_question(question)), dtype=np.float32)
+    vector /= np.linalg.norm(vector) or 1.0
+    return key, vector
+
+def cached_answer(question, response_format=None, phase=None):
+    # -> (answer, similarity) or None
+    answer_cache = get_answer_cache()
+    if answer_cache is None:
+        return None
+    key, vector = answer_cache_key(question, response_format, phase)
+    return answer_cache.lookup(key, vector)
+
+def cache_answer(question, answer, response_format=None, phase=None):
+    answer_cache = get_answer_cache()
+    if answer_cache is None or not answer:
         return
+    key, vector = answer_cache_key(question, response_format, phase)
+    answer_cache.store(key, vector, question, answer)
+
+# ---------- RAG QUERY ----------
+
+def fuse_results(collection, vector, lexical, n_results):
+    # Reciprocal rank fusion of the vector hits and the BM25 hits, returned in
+    # the same shape as collection.query(). Lexical-only hits have no vector
+    # distance (None).
+    scores = {}
+    for rank, chunk_id in enumerate(vector["ids"][0]):
+        scores[chunk_id] = scores.get(chunk_id, 0.0) + 1 / (RRF_K + rank + 1)
+    for rank, (chunk_id, _) in enumerate(lexical):
+        scores[chunk_id] = scores.get(chunk_id, 0.0) + 1 / (RRF_K + rank + 1)
+    fused = sorted(scores, key=scores.get, reverse=True)[:n_results]
 
-    print("Ingesting documents...")
+    known = {
+        chunk_id: (document, metadata, distance)
+        for chunk_id, document, metadata, distance in zip(
+            vector["ids"][0],
+            vector["documents"][0],
+            vector["metadatas"][0],
+            vector["distances"][0]
+        )
+    }
+    missing = [chunk_id for chunk_id in fused if chunk_id not in known]
+    if missing:
+        extra = collection.get(ids=missing, include=["documents", "metadatas"])
+        for chunk_id, document, metadata in zip(
+            extra["ids"], extra["documents"], extra["metadatas"]
+        ):
+            known[chunk_id] = (document, metadata, None)
+    fused = [chunk_id for chunk_id in fused if chunk_id in known]
 
-    all_chunks = []
-    all_ids = []
+    return {
+        "ids": [fused],
+        "documents": [[known[c][0] for c in fused]],
+        "metadatas": [[known[c][1] for c in fused]],
+        "distances": [[known[c][2] for c in fused]],
+    }
 
-    for file in Path(DOCS_FOLDER).iterdir():
-        # Print the file name
-        print(f"Processing file: {file.name}")
+def query_collection(question, n_results=N_RESULTS):
 
-        # Read file
-        if file.suffix.lower() == ".pdf":
-            text = read_pdf(file)
+    text = normalize_question(question)
+    key = (text, n_results)
 
-        elif file.suffix.lower() == ".docx":
-            text = read_docx(file)
+    results = retrieval_cache.get(key)
+    if results is None:
+        collection = get_collection()
+        with span("encode"):
+            vector = embed_query(text)
+        with span("vector_query"):
+            results = query_vectors(collection, [list(vector)], n_results)
+        if HYBRID_SEARCH:
+            with span("lexical_query"):
+                lexical = lexical_index.search(text, n_results)
+                results = fuse_results(collection, results, lexical, n_results)
+        retrieval_cache.put(key, results)
 
+    return results
+
+def prefetch_retrieval(questions, n_results=N_RESULTS):
+    # Bulk query_collection(): one encode call and one vectorized Chroma query
+    # for every question not cached yet. -> {normalized question: results}
+    # for the caller to hand to each retrieve_context(); a batch can outlive
+    # retrieval_cache entries, so they are not relied on.
+    found = {}
+    texts = []
+    for text in dict.fromkeys(normalize_question(q) for q in questions):
+        results = retrieval_cache.get((text, n_results))
+        if results is None:
+            texts.append(text)
         else:
-            print(f"Skipping unsupported file: {file.name}")
+            found[text] = results
+    if not texts:
+        return found
+
+    collection = get_collection()
+    with span("encode"):
+        vectors = get_embed_model().encode(texts, batch_size=EMBED_BATCH_SIZE)
+    with span("vector_query"):
+        batch = query_vectors(
+            collection, np.asarray(vectors, dtype=np.float32).tolist(), n_results
+        )
+    for i, text in enumerate(texts):
+        results = {
+            key: [batch[key][i]] for key in ("ids", "documents", "metadatas", "distances")
+        }
+        if HYBRID_SEARCH:
+            with span("lexical_query"):
+                lexical = lexical_index.search(text, n_results)
+                results = fuse_results(collection, results, lexical, n_results)
+        retrieval_cache.put((text, n_results), results)
+        found[text] = results
+    return found
+
+# ---------- CONTEXT ASSEMBLY ----------
+
+def shingles(text, n=3):
+    words = text.lower().split()
+    return {tuple(words[i:i + n]) for i in range(max(len(words) - n + 1, 1))}
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b) if a and b else 0.0
+
+def count_tokens(text, metadata=None):
+    if metadata and "tokens" in metadata:
+        return metadata["tokens"]
+    # verbose=False: long texts are only counted here, never fed to the model
+    return len(get_tokenizer()(text, add_special_tokens=False, verbose=False)["input_ids"])
+
+def source_tag(chunk_id, metadata):
+    if not metadata or "source" not in metadata:
+        return chunk_id
+    first, last = metadata.get("page_start"), metadata.get("page_end")
+    if first is None:
+        return metadata["source"]
+    pages = f"p. {first}" if first == last else f"pp. {first}-{last}"
+    return f"{metadata['source']}, {pages}"
+
+def assemble_context(
+    results,
+    budget=CONTEXT_TOKEN_BUDGET,
+    max_distance=CONTEXT_MAX_DISTANCE,
+    duplicate_similarity=CONTEXT_DUPLICATE_SIMILARITY
+):
+    # Walks the candidates in relevance order and keeps those that are close
+    # enough, not a near-copy of a passage already kept, and still fit the
+    # budget. -> (context, stats)
+    ids = results["ids"][0]
+    documents = results["documents"][0]
+    metadatas = (results.get("metadatas") or [[None] * len(ids)])[0]
+    distances = (results.get("distances") or [[0.0] * len(ids)])[0]
+
+    picked = []
+    kept = []
+    used = total = 0
+    for chunk_id, document, metadata, distance in zip(
+        ids, documents, metadatas, distances
+    ):
+        n = count_tokens(document, metadata)
+        total += n
+        # Lexical-only hits (distance None) are kept: they matched exact terms
+        if distance is not None and distance > max_distance:
+            continue
+        sh = shingles(document)
+        if any(jaccard(sh, other) >= duplicate_similarity for other in kept):
+            continue
+        if used + n > budget:
             continue
+        picked.append(f"[{source_tag(chunk_id, metadata)}]\n{document}")
+        kept.append(sh)
+        used += n
 
-        # Split into chunks
-        chunks = chunk_text(text)
+    stats = {"candidates": len(ids), "chunks": len(picked), "tokens": used, "saved": total - used}
+    return "\n\n".join(picked), stats
 
-        # Add each chunk with file name in ID
-        for j, chunk in enumerate(chunks):
-            all_chunks.append(chunk)
-            all_ids.append(f"{file.name}_{j}")
+def retrieve_context(question, results=None):
 
-    # Compute embeddings
-    embeddings = embed_model.encode(all_chunks).tolist()
+    if results is None:
+        results = query_collection(question)
 
-    # Add to Chroma
-    collection.add(
-        documents=all_chunks,
-        embeddings=embeddings,
-        ids=all_ids
+    with span("assemble_context"):
+        context, stats = assemble_context(results)
+    print(
+        f"Context: {stats['chunks']}/{stats['candidates']} chunks, "
+        f"{stats['tokens']} tokens ({stats['saved']} saved)"
     )
 
-    print("Ingestion complete.")
+    return context
 
-# ---------- RAG QUERY ----------
+# ---------- EXEMPLARS ----------
+
+# Curated persona exchanges ({"messages": [system, user, assistant]} per
+# line, the fine-tuning format) show the voice better than a description of
+# it. Every *.jsonl in EXEMPLARS_FOLDER is streamed into a second collection
+# in EMBED_BATCH_SIZE batches. The user turn is embedded, and the answer and
+# its format go in the metadata. A line may carry "format" itself; otherwise
+# it is guessed from the markers PERSONA describes. The exchanges are undated
+# and PERSONA's era phrases hardly occur in them, so they are not labelled
+# or filtered by era. Files are tracked by sha256 like ./docs.
+#
+# At question time the closest exchanges for the selected format go into the
+# prompt, EXEMPLAR_COUNT at most. With them comes the compact persona
+# (persona_for(..., compact=True)), and they get no more tokens than it
+# saves, nor more than EXEMPLAR_TOKEN_BUDGET: exemplars make the prompt
+# shorter, never longer.
+
+EXEMPLAR_LABELS_VERSION = 2
+EXEMPLAR_SPOKEN = re.compile(r"\[(?:chuckles|laughs)[^\]]*\]|\b(?:uh|um)\b|\bI(?:--|—) ", re.I)
+def get_exemplar_collection():
+    return lazy(
+        "exemplar_collection",
+        lambda: get_client().get_or_create_collection("exemplars", metadata=hnsw_metadata())
+    )
+
+def label_exemplar(answer):
+    # -> format key
+    if answer.lstrip().lower().startswith("dear"):
+        return "email"
+    if EXEMPLAR_SPOKEN.search(answer):
+        return "conversational"
+    return "question"
+
+def parse_exemplar(line):
+    # -> (question, answer, format), or None for anything else
+    data = json.loads(line)
+    turns = {m.get("role"): m.get("content") for m in data.get("messages", [])}
+    question, answer = turns.get("user"), turns.get("assistant")
+    if not question or not answer:
+        return None
+    return question, answer, format_key(data.get("format")) or label_exemplar(answer)
+
+def load_exemplar_manifest():
+    if not os.path.exists(EXEMPLAR_MANIFEST_PATH):
+        return {}
+    with open(EXEMPLAR_MANIFEST_PATH, encoding="utf-8") as f:
+        return json.load(f)
 
-def retrieve_context(question):
+def save_exemplar_manifest(manifest):
+    os.makedirs(DB_PATH, exist_ok=True)
+    tmp = EXEMPLAR_MANIFEST_PATH + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, EXEMPLAR_MANIFEST_PATH)
 
-    embedding = embed_model.encode([question])[0].tolist()
+def ingest_exemplars():
+    collection = get_exemplar_collection()
+    manifest = load_exemplar_manifest()
+    folder = Path(EXEMPLARS_FOLDER)
+    files = sorted(folder.glob("*.jsonl")) if folder.is_dir() else []
+    present = {file.name for file in files}
+    start = time.monotonic()
+    counts = {"files": 0, "exemplars": 0, "skipped": 0}
+
+    def drop(name):
+        n = manifest.pop(name)["exemplars"]
+        if n:
+            collection.delete(ids=chunk_ids(name, 0, n))
+        save_exemplar_manifest(manifest)
+        collection_changed()
+
+    for name in sorted(set(manifest) - present):
+        drop(name)
+        print(f"Removed exemplar file: {name}")
+
+    for file in files:
+        digest = file_sha256(file)
+        entry = manifest.get(file.name)
+        if entry and entry["sha256"] == digest and entry.get("labels") == EXEMPLAR_LABELS_VERSION:
+            continue
+        if entry:
+            drop(file.name)
+
+        batch = []
+        lines = 0
+
+        def flush():
+            if not batch:
+                return
+            questions = [question for _, (question, _, _) in batch]
+            collection.upsert(
+                ids=[f"{file.name}_{j}" for j, _ in batch],
+                documents=questions,
+                embeddings=embedding_cache.encode(questions, batch_size=EMBED_BATCH_SIZE).tolist(),
+                metadatas=[
+                    {
+                        "answer": answer,
+                        "format": response_format,
+                        "tokens": count_tokens(f"{question}\n{answer}"),
+                        "source": file.name,
+                    }
+                    for _, (question, answer, response_format) in batch
+                ]
+            )
+            counts["exemplars"] += len(batch)
+            batch.clear()
+
+        with open(file, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    exemplar = parse_exemplar(line)
+                except (ValueError, AttributeError, TypeError):
+                    exemplar = None
+                if exemplar is None:
+                    counts["skipped"] += 1
+                    continue
+                batch.append((lines, exemplar))
+                lines += 1
+                if len(batch) == EMBED_BATCH_SIZE:
+                    flush()
+            flush()
+
+        manifest[file.name] = {
+            "sha256": digest, "labels": EXEMPLAR_LABELS_VERSION, "exemplars": lines,
+        }
+        save_exemplar_manifest(manifest)
+        collection_changed()
+        counts["files"] += 1
+        print(f"Exemplar file: {file.name} ({lines} exemplars)")
+
+    if counts["files"] or counts["skipped"]:
+        print(
+            f"Exemplars: {counts['exemplars']} from {counts['files']} files in "
+            f"{time.monotonic() - start:.1f}s, {counts['skipped']} lines skipped, "
+            f"{collection.count()} stored."
+        )
+
+def exemplar_filters(response_format):
+    # The selected format first; there are few email exemplars
+    f = format_key(response_format)
+    return [{"format": f}, None] if f else [None]
+
+def retrieve_exemplars(
+    question, response_format=None, count=EXEMPLAR_COUNT, budget=EXEMPLAR_TOKEN_BUDGET
+):
+    # -> (exemplar block for the prompt or "", stats)
+    stats = {"exemplars": 0, "tokens": 0}
+    if count <= 0 or budget <= 0:
+        return "", stats
+    collection = get_exemplar_collection()
+    n = collection.count()
+    if n == 0:
+        return "", stats
+
+    text = normalize_question(question)
+    key = ("exemplars", text, format_key(response_format), count)
+    results = retrieval_cache.get(key)
+    if results is None:
+        with span("exemplar_query"):
+            vector = embed_query(text)
+            seen = set()
+            results = []
+            for where in exemplar_filters(response_format):
+                found = collection.query(
+                    query_embeddings=[list(vector)],
+                    n_results=min(count * 2, n),
+                    where=where,
+                    include=["documents", "metadatas"]
+                )
+                for chunk_id, document, metadata in zip(
+                    found["ids"][0], found["documents"][0], found["metadatas"][0]
+                ):
+                    if chunk_id not in seen:
+                        seen.add(chunk_id)
+                        results.append((document, metadata))
+                if len(results) >= count:
+                    break
+        retrieval_cache.put(key, results)
+
+    picked = []
+    for document, metadata in results:
+        if len(picked) == count:
+            break
+        if stats["tokens"] + metadata["tokens"] > budget:
+            continue
+        picked.append(f"Q: {document}\nJH: {metadata['answer']}")
+        stats["tokens"] += metadata["tokens"]
+    stats["exemplars"] = len(picked)
+    return "\n\n".join(picked), stats
 
-    results = collection.query(
-        query_embeddings=[embedding],
-        n_results=6
+def retrieve_examples(question, response_format=None, phase=None):
+    full = persona_tokens(response_format, phase)
+    compact = persona_tokens(response_format, phase, compact=True)
+    examples, stats = retrieve_exemplars(
+        question, response_format, budget=min(EXEMPLAR_TOKEN_BUDGET, full - compact)
     )
+    if stats["exemplars"]:
+        print(
+            f"Exemplars: {stats['exemplars']}, {stats['tokens']} tokens; persona and "
+            f"exemplars {full} -> {compact + stats['tokens']} input tokens"
+        )
+    return examples
 
-    return "\n\n".join(results["documents"][0])
+# ---------- ADMISSION CONTROL ----------
 
-# ---------- CLAUDE CHAT ----------
+# A burst of users used to go straight to the provider and come back as
+# 429/529s. Claude calls now pass through `admission`: at most
+# CLAUDE_MAX_CONCURRENCY run at once, at most CLAUDE_QUEUE_SIZE wait for a
+# slot, and none waits longer than CLAUDE_QUEUE_TIMEOUT. Requests that cannot
+# be queued fail fast with 503 and a Retry-After estimated from how long calls
+# have been taking. Cached answers never queue. Retryable provider errors are
+# retried with full-jitter exponential backoff, honouring the provider's
+# retry-after; when retries run out the client gets a 503 too.
+#
+# Limits are per worker process. Queue depth, slots in use, queue wait
+# (stage "queue_wait"), rejections and retries are exported on /metrics and
+# summarized on /admission/stats.
+
+RETRYABLE_STATUS = (408, 409, 429)
+
+ADMISSION_QUEUED = Gauge(
+    "professor_admission_queued", "Requests waiting for a Claude slot",
+    multiprocess_mode="livesum"
+)
+ADMISSION_ACTIVE = Gauge(
+    "professor_admission_active", "Claude calls in flight",
+    multiprocess_mode="livesum"
+)
+ADMISSION_REJECTED = Counter(
+    "professor_admission_rejected", "Requests turned away by admission control",
+    ["reason"]  # queue_full, deadline, provider
+)
+CLAUDE_RETRIES_TOTAL = Counter(
+    "professor_claude_retries", "Retried Claude calls by error",
+    ["error"]  # status code or "connection"
+)
+
+class Overloaded(Exception):
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f"overloaded: {reason}")
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+
+class Admission:
+
+    def __init__(self, limit, queue_size, timeout):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.semaphore = asyncio.Semaphore(limit)
+        self.active = 0
+        self.queued = 0
+        # Moving average of slot hold time: a plain mean over the first ten
+        # calls, so it starts from measured calls rather than a guess
+        self.service_seconds = 0.0
+        self.calls = 0
+        self.counts = {"admitted": 0, "queue_full": 0, "deadline": 0}
+        self.wait_total = 0.0
+
+    def retry_after(self):
+        # Time for the queue ahead of a new request to drain
+        return self.service_seconds * (self.queued + 1) / self.limit
+
+    def full(self):
+        # Counted here, not from the semaphore: a waiter is only registered
+        # with it once its acquire task first runs
+        return self.active + self.queued >= self.limit + self.queue_size
+
+    async def acquire(self):
+        # Waits for a slot -> release(), which may safely be called twice
+        if self.full():
+            self.reject("queue_full")
+        start = time.perf_counter()
+        self.queued += 1
+        ADMISSION_QUEUED.inc()
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self.reject("deadline")
+        finally:
+            self.queued -= 1
+            ADMISSION_QUEUED.dec()
+        waited = time.perf_counter() - start
+        observe("queue_wait", waited)
+        self.counts["admitted"] += 1
+        self.wait_total += waited
+
+        self.active += 1
+        ADMISSION_ACTIVE.inc()
+        start = time.perf_counter()
+        released = False
+
+        def release():
+            nonlocal released
+            if released:
+                return
+            released = True
+            self.active -= 1
+            ADMISSION_ACTIVE.dec()
+            self.semaphore.release()
+            self.calls += 1
+            weight = max(0.1, 1 / self.calls)
+            self.service_seconds += weight * (time.perf_counter() - start - self.service_seconds)
+
+        return release
+
+    @asynccontextmanager
+    async def slot(self):
+        release = await self.acquire()
+        try:
+            yield
+        finally:
+            release()
+
+    def reject(self, reason):
+        self.counts[reason] += 1
+        ADMISSION_REJECTED.labels(reason).inc()
+        raise Overloaded(reason, self.retry_after())
+
+    def stats(self):
+        return {
+            "limit": self.limit,
+            "queue_size": self.queue_size,
+            "queue_timeout": self.timeout,
+            "active": self.active,
+            "queued": self.queued,
+            **self.counts,
+            "mean_wait_ms": round(1000 * self.wait_total / max(self.counts["admitted"], 1), 1),
+            "service_seconds": round(self.service_seconds, 2),
+        }
+
+admission = Admission(CLAUDE_MAX_CONCURRENCY, CLAUDE_QUEUE_SIZE, CLAUDE_QUEUE_TIMEOUT)
+
+def retry_label(error):
+    # Metric label of a retryable provider error, None for a final one
+    import anthropic
+    if isinstance(error, anthropic.APIStatusError):
+        status = error.status_code
+        return str(status) if status in RETRYABLE_STATUS or status >= 500 else None
+    if isinstance(error, anthropic.APIConnectionError):
+        return "connection"
+    return None
+
+def backoff(error, attempt, background=False):
+    # Seconds to wait before retrying after failed attempt `attempt` (0-based).
+    # Re-raises final errors; raises Overloaded once retries are used up.
+    # Background calls turn no client away, so they are not counted as
+    # rejections when they give up.
+    label = retry_label(error)
+    if label is None:
+        raise error
+    delay = random.uniform(0, min(CLAUDE_BACKOFF_MAX, CLAUDE_BACKOFF_BASE * 2 ** attempt))
+    response = getattr(error, "response", None)
+    hint = response.headers.get("retry-after") if response is not None else None
+    try:
+        delay = min(max(delay, float(hint)), CLAUDE_BACKOFF_MAX) if hint else delay
+    except ValueError:
+        pass
+    if attempt >= CLAUDE_RETRIES:
+        if not background:
+            ADMISSION_REJECTED.labels("provider").inc()
+        raise Overloaded("provider", delay) from error
+    CLAUDE_RETRIES_TOTAL.labels(label).inc()
+    print(f"Claude call failed ({label}), retry {attempt + 1} in {delay:.1f}s")
+    return delay
+
+# ---------- SESSIONS ----------
+
+# A session ID (the frontend's sessionId) maps to the conversation so far: a
+# rolling summary plus the most recent turns, kept verbatim while they fit
+# HISTORY_TOKEN_BUDGET. Once they don't, the oldest turns are folded into the
+# summary (at most SUMMARY_TOKEN_BUDGET) by a background call to
+# CLAUDE_SUMMARY_MODEL, so the prompt stays roughly the same size however
+# long the chat runs. Only questions and answers are kept, not the writings
+# retrieved for them.
+#
+# Sessions live in an in-memory LRU. With SESSION_STORE=1 they are also
+# written to SQLite, which survives restarts and is shared by all workers:
+# the cached copy is used only while its `updated` stamp matches the row.
+# Follow-up questions land on any worker, so SESSION_STORE defaults to 1
+# when WEB_WORKERS > 1 and serve_workers() refuses to start without it.
+
+class SessionStore:
+
+    def __init__(self, max_entries, ttl, path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+        self.db = None
+
+        if path:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self.db.execute("pragma journal_mode=wal")
+            self.db.execute(
+                "create table if not exists sessions ("
+                " id text primary key,"
+                " summary text not null,"
+                " turns text not null,"
+                " updated real not null)"
+            )
+            self.db.execute(
+                "delete from sessions where updated < ?", (time.time() - ttl,)
+            )
 
-def ask_claude(question):
+    def _load(self, session_id):
+        session = self.sessions.get(session_id)
+        if self.db is not None:
+            row = self.db.execute(
+                "select summary, turns, updated from sessions where id = ?",
+                (session_id,)
+            ).fetchone()
+            # Another worker may have moved the session on
+            if row and (session is None or session["updated"] != row[2]):
+                session = {"summary": row[0], "turns": json.loads(row[1]), "updated": row[2]}
+        if session is None or time.time() - session["updated"] > self.ttl:
+            session = {"summary": "", "turns": [], "updated": 0.0}
+        return session
 
-    context = retrieve_context(question)
+    def _remember(self, session_id, session):
+        self.sessions[session_id] = session
+        self.sessions.move_to_end(session_id)
+        while len(self.sessions) > self.max_entries:
+            self.sessions.popitem(last=False)
 
-    prompt = f"""
-{PERSONA}
+    def get(self, session_id):
+        # -> {"summary", "turns", "updated"}, empty for an unknown session
+        with self.lock:
+            session = self._load(session_id)
+            self._remember(session_id, session)
+            return copy.deepcopy(session)
 
+    def update(self, session_id, change):
+        # Read-modify-write; with SQLite the write lock also holds off other workers
+        with self.lock:
+            if self.db is not None:
+                self.db.execute("begin immediate")
+            try:
+                session = copy.deepcopy(self._load(session_id))
+                change(session)
+                session["updated"] = time.time()
+                if self.db is not None:
+                    self.db.execute(
+                        "insert or replace into sessions (id, summary, turns, updated)"
+                        " values (?, ?, ?, ?)",
+                        (session_id, session["summary"], json.dumps(session["turns"]), session["updated"])
+                    )
+                    self.db.execute("commit")
+            except Exception:
+                if self.db is not None:
+                    self.db.execute("rollback")
+                raise
+            self._remember(session_id, session)
+            return copy.deepcopy(session)
+
+def get_sessions():
+    # Opened on first use, so each worker has its own connection
+    return lazy("sessions", lambda: SessionStore(
+        SESSION_CACHE_SIZE,
+        SESSION_TTL,
+        SESSION_STORE_PATH if SESSION_STORE else None
+    ))
+
+# One summarizer per worker: folding is rare and never on a request's path
+summary_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+SUMMARY_PROMPT = """Update the running summary of a conversation between a user and Professor James Hankins.
+Keep the names, works, periods and arguments discussed, what the user asked for and the positions the professor took; drop greetings and sign-offs.
+Write at most {words} words of plain prose.
+
+Summary so far:
+{summary}
+
+Exchanges to add:
+{exchanges}
+
+Updated summary:"""
+
+def has_history(session):
+    return bool(session and (session["turns"] or session["summary"]))
+
+def history_tokens(session):
+    return sum(turn["tokens"] for turn in session["turns"])
+
+def conversation_query(question, session=None, turns=2):
+    # Follow-ups ("and in his later work?") retrieve poorly on their own, so
+    # the previous questions are added. The new one goes first: the embedding
+    # model truncates from the end.
+    if not session or not session["turns"]:
+        return question
+    previous = [turn["question"] for turn in session["turns"][-turns:]]
+    return "\n".join([question, *reversed(previous)])
+
+def summarize_turns(summary, turns):
+
+    import anthropic
+
+    exchanges = "\n\n".join(
+        f"User: {turn['question']}\nProfessor: {turn['answer']}" for turn in turns
+    )
+    prompt = SUMMARY_PROMPT.format(
+        words=int(SUMMARY_TOKEN_BUDGET * 0.75),
+        summary=summary or "(none yet)",
+        exchanges=exchanges
+    )
+    start = time.monotonic()
+    for attempt in range(CLAUDE_RETRIES + 1):
+        try:
+            response = get_claude().messages.create(
+                model=CLAUDE_SUMMARY_MODEL,
+                max_tokens=SUMMARY_TOKEN_BUDGET * 2,
+                temperature=0,
+                messages=[
+                    {"role": "user", "content": prompt}
+                ]
+            )
+            break
+        except anthropic.APIError as e:
+            time.sleep(backoff(e, attempt, background=True))
+    log_usage(response.usage, time.monotonic() - start)
+    return response.content[0].text.strip()
+
+def fold_session(session_id):
+    session = get_sessions().get(session_id)
+    turns = session["turns"]
+    total = history_tokens(session)
+    folded = []
+    while len(turns) - len(folded) > 1 and total > HISTORY_TOKEN_BUDGET:
+        total -= turns[len(folded)]["tokens"]
+        folded.append(turns[len(folded)])
+    if not folded:
+        return
+
+    try:
+        summary = summarize_turns(session["summary"], folded)
+    except Exception as e:
+        # Drop the turns anyway: the prompt must stay bounded
+        print(f"Session summary failed: {type(e).__name__}: {e}")
+        summary = session["summary"]
+
+    def apply(current):
+        # Turns recorded while we were summarizing stay
+        if current["turns"][:len(folded)] == folded:
+            current["turns"] = current["turns"][len(folded):]
+            current["summary"] = summary
+    get_sessions().update(session_id, apply)
+    print(f"Session {session_id}: folded {len(folded)} turns into the summary")
+
+def load_session(session_id):
+    return get_sessions().get(session_id)
+
+def record_turn(session_id, question, answer):
+    turn = {
+        "question": question,
+        "answer": answer,
+        "tokens": count_tokens(question) + count_tokens(answer),
+    }
+    session = get_sessions().update(session_id, lambda s: s["turns"].append(turn))
+    if len(session["turns"]) > 1 and history_tokens(session) > HISTORY_TOKEN_BUDGET:
+        summary_executor.submit(fold_session, session_id)
+
+# ---------- CLAUDE CHAT ----------
+
+# PERSONA goes first as a system block marked for prompt caching: it is the
+# same on every call, so after the first request the provider reads it from
+# cache instead of processing it again. Only the retrieved context and the
+# question, which change per request, follow it.
+
+def build_system(persona=PERSONA):
+    return [
+        {
+            "type": "text",
+            "text": persona,
+            "cache_control": {"type": "ephemeral"},
+        }
+    ]
+
+def build_prompt(question, context, summary="", examples=""):
+    earlier = f"\nEarlier in this conversation (summary):\n{summary}\n" if summary else ""
+    shown = (
+        f"\nHow JH has answered similar questions (for voice only; facts come "
+        f"from the writings above):\n{examples}\n"
+    ) if examples else ""
+    return f"""{earlier}
 Relevant writings:
 {context}
-
+{shown}
 Question:
 {question}
 """
 
-    response = claude.messages.create(
-        model="claude-opus-4-6",
-        max_tokens=1200,
-        temperature=0.4,
-        messages=[
-            {"role": "user", "content": prompt}
-        ]
+def build_messages(prompt, session=None):
+    # Recent turns go in as real exchanges. The last one carries a cache
+    # breakpoint, so the next turn reads persona and history from the cache.
+    messages = []
+    for turn in session["turns"] if session else []:
+        messages.append({"role": "user", "content": turn["question"]})
+        messages.append({"role": "assistant", "content": turn["answer"]})
+    if messages:
+        messages[-1]["content"] = [{
+            "type": "text",
+            "text": messages[-1]["content"],
+            "cache_control": {"type": "ephemeral"},
+        }]
+    messages.append({"role": "user", "content": prompt})
+    return messages
+
+def log_history(session):
+    if has_history(session):
+        print(
+            f"History: {len(session['turns'])} turns, {history_tokens(session)} tokens"
+            f" + summary {count_tokens(session['summary']) if session['summary'] else 0} tokens"
+        )
+
+def log_usage(usage, elapsed, first_token=None):
+    cache_read = getattr(usage, "cache_read_input_tokens", None) or 0
+    cache_write = getattr(usage, "cache_creation_input_tokens", None) or 0
+    status = "hit" if cache_read else ("write" if cache_write else "miss")
+    ttft = f", first token {first_token:.2f}s" if first_token is not None else ""
+    CLAUDE_TOKENS.labels("input").inc(usage.input_tokens)
+    CLAUDE_TOKENS.labels("output").inc(usage.output_tokens)
+    CLAUDE_TOKENS.labels("cache_read").inc(cache_read)
+    CLAUDE_TOKENS.labels("cache_write").inc(cache_write)
+    print(
+        f"Claude: prompt cache {status}, input {usage.input_tokens} "
+        f"(+{cache_read} cached, +{cache_write} cache write), "
+        f"output {usage.output_tokens}, {elapsed:.2f}s{ttft}"
     )
 
+def prepare_claude(question, response_format=None, phase=None, session=None, results=None):
+    # Retrieval (unless `results` were prefetched) and prompt assembly
+    # -> (system, messages) for call_claude()
+
+    log_history(session)
+    context = retrieve_context(conversation_query(question, session), results)
+    examples = retrieve_examples(question, response_format, phase)
+
+    with span("prompt"):
+        system = build_system(persona_for(response_format, phase, compact=bool(examples)))
+        prompt = build_prompt(
+            question, context, session["summary"] if session else "", examples
+        )
+        messages = build_messages(prompt, session)
+    return system, messages
+
+def call_claude(system, messages):
+    # -> (answer, stop_reason)
+
+    import anthropic
+
+    start = time.monotonic()
+    with span("claude"):
+        # backoff() raises once the retries are used up
+        for attempt in range(CLAUDE_RETRIES + 1):
+            try:
+                response = get_claude().messages.create(
+                    model=CLAUDE_MODEL,
+                    max_tokens=CLAUDE_MAX_TOKENS,
+                    temperature=CLAUDE_TEMPERATURE,
+                    system=system,
+                    messages=messages
+                )
+                break
+            except anthropic.APIError as e:
+                time.sleep(backoff(e, attempt))
+    log_usage(response.usage, time.monotonic() - start)
+
     print("\nProfessor:\n")
     # print(response.content[0].text)
-    return response.content[0].text
+    return response.content[0].text, response.stop_reason
+
+def ask_claude(question, response_format=None, phase=None, session=None):
+    return call_claude(*prepare_claude(question, response_format, phase, session))[0]
+
+# ---------- STREAMING CHAT ----------
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def stream_claude(
+    question, response_format=None, phase=None,
+    cached=None, release=None, session_id=None, session=None
+):
+
+    # The endpoint looks up the answer cache (`cached`) and, on a miss, holds
+    # an admission slot for the stream; `release` hands it back. The turn is
+    # recorded in the session before "done" goes out.
+
+    import anthropic
+
+    if cached:
+        answer, similarity = cached
+        yield sse_event("token", {"text": answer})
+        if session_id:
+            await run_in_threadpool(record_turn, session_id, question, answer)
+        yield sse_event("done", {
+            "stop_reason": "cache_hit",
+            "cache_hit": True,
+            "similarity": similarity,
+        })
+        finish_request("ask_stream", "cache_hit")
+        return
+
+    first_token = None
+    parts = []
+    outcome = "error"
+    try:
+        # Embedding and the Chroma lookup are CPU-bound: keep them off the event loop
+        system, messages = await run_in_threadpool(
+            prepare_claude, question, response_format, phase, session
+        )
+
+        start = time.monotonic()
+        with span("claude"):
+            for attempt in range(CLAUDE_RETRIES + 1):
+                try:
+                    async with get_async_claude().messages.stream(
+                        model=CLAUDE_MODEL,
+                        max_tokens=CLAUDE_MAX_TOKENS,
+                        temperature=CLAUDE_TEMPERATURE,
+                        system=system,
+                        messages=messages
+                    ) as stream:
+                        async for text in stream.text_stream:
+                            if first_token is None:
+                                first_token = time.monotonic() - start
+                                observe("claude_first_token", first_token)
+                            parts.append(text)
+                            yield sse_event("token", {"text": text})
+                        message = await stream.get_final_message()
+                    break
+                except anthropic.APIError as e:
+                    # Tokens already sent cannot be taken back
+                    if parts:
+                        raise
+                    await asyncio.sleep(backoff(e, attempt))
+        if release:
+            release()
+        log_usage(message.usage, time.monotonic() - start, first_token)
+        answer = "".join(parts)
+        # With history the answer depends on more than the question: don't cache it
+        if message.stop_reason == "end_turn" and not has_history(session):
+            await run_in_threadpool(
+                cache_answer, question, answer, response_format, phase
+            )
+        if session_id:
+            await run_in_threadpool(record_turn, session_id, question, answer)
+        yield sse_event("done", {
+            "stop_reason": message.stop_reason,
+            "cache_hit": False,
+        })
+        outcome = "answered"
+    # Headers are already sent, so report failures in-band
+    except Overloaded as e:
+        outcome = "rejected"
+        yield sse_event("error", {"error": str(e), "retry_after": e.retry_after})
+    except anthropic.APIError as e:
+        print(f"Claude stream failed: {e}")
+        yield sse_event("error", {"error": str(e)})
+    finally:
+        if release:
+            release()
+        finish_request("ask_stream", outcome)
+
+# ---------- BATCH ----------
+
+# Bulk evaluation and feedback runs. Input is a JSONL of {"message",
+# "response_format", "phase", optional "id"}; output is one JSONL line per
+# input line, {"index", "id", "answer"} or {"index", "id", "error"}, in
+# completion order. Retrieval for the whole batch is one encode call and one
+# Chroma query (prefetch_retrieval), whose results go straight into each
+# line's prompt. The Claude calls run BATCH_CONCURRENCY at
+# a time, still through admission control, and wait out a 503 instead of
+# failing. A bad line or a failed call becomes an error line and the rest
+# carry on. Batch lines skip the answer cache and sessions: each one is
+# answered afresh and on its own.
+
+def parse_batch(lines):
+    # -> [(index, id, MessageRequest or None, error or None)]
+    items = []
+    for line in lines:
+        if not line.strip():
+            continue
+        index = len(items)
+        try:
+            data = json.loads(line)
+            items.append((index, data.get("id"), MessageRequest(**data), None))
+        except (ValueError, TypeError, AttributeError) as e:
+            items.append((index, None, None, f"invalid line: {e}"))
+    return items
+
+async def run_batch(items, concurrency=BATCH_CONCURRENCY, counts=None):
+    # `counts` ({"answer", "error"}) is filled in for the caller as lines finish
+
+    def line(index, item_id, **result):
+        return json.dumps({"index": index, "id": item_id, **result}) + "\n"
+
+    start = time.monotonic()
+    if counts is None:
+        counts = {}
+    counts.update({"answer": 0, "error": 0})
+
+    prefetched = {}
+    try:
+        prefetched = await run_in_threadpool(
+            prefetch_retrieval, [item.message for _, _, item, _ in items if item]
+        )
+    except Exception as e:
+        # Each question then retrieves on its own
+        print(f"Batch prefetch failed: {type(e).__name__}: {e}")
+
+    limit = asyncio.Semaphore(concurrency)
+
+    async def answer(index, item_id, item):
+        async with limit:
+            try:
+                system, messages = await run_in_threadpool(
+                    prepare_claude, item.message, item.response_format, item.phase,
+                    None, prefetched.get(normalize_question(item.message))
+                )
+                for attempt in range(CLAUDE_RETRIES + 1):
+                    try:
+                        async with admission.slot():
+                            text, _ = await run_in_threadpool(call_claude, system, messages)
+                        counts["answer"] += 1
+                        return line(index, item_id, answer=text)
+                    except Overloaded as e:
+                        # Nobody is waiting on a batch: take the Retry-After
+                        if attempt == CLAUDE_RETRIES:
+                            raise
+                        await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                print(f"Batch line {index} failed: {type(e).__name__}: {e}")
+                counts["error"] += 1
+                return line(index, item_id, error=f"{type(e).__name__}: {e}")
+
+    for index, item_id, item, error in items:
+        if error:
+            counts["error"] += 1
+            yield line(index, item_id, error=error)
+
+    tasks = [
+        asyncio.create_task(answer(index, item_id, item))
+        for index, item_id, item, _ in items if item
+    ]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        # Stops the rest if the client has gone away
+        for task in tasks:
+            task.cancel()
+
+    print(
+        f"Batch: {counts['answer']} answered, {counts['error']} failed "
+        f"in {time.monotonic() - start:.1f}s"
+    )
+
+def run_batch_file(source, target):
+    with open(source, encoding="utf-8") as f:
+        items = parse_batch(f)
+
+    async def run():
+        with open(target, "w", encoding="utf-8") as out:
+            async for result in run_batch(items):
+                out.write(result)
+                out.flush()
+
+    asyncio.run(run())
 
 # ---------- INTERACTIVE CHAT ----------
 
@@ -601,21 +3885,306 @@ Question:
 #     ingest_documents()
 #     chat_loop()
 
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request, exc):
+
+    return JSONResponse(
+        {"error": "overloaded", "reason": exc.reason, "retry_after": exc.retry_after},
+        status_code=503,
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
 @app.post("/ask")
-def api_ask(request: MessageRequest):
+async def api_ask(request: MessageRequest):
+
+    session = None
+    if request.session_id:
+        session = await run_in_threadpool(load_session, request.session_id)
+
+    # A follow-up in a conversation is not the same question asked afresh
+    cached = None
+    if not has_history(session):
+        cached = await run_in_threadpool(
+            cached_answer, request.message, request.response_format, request.phase
+        )
+    if cached:
+        answer, similarity = cached
+        if request.session_id:
+            await run_in_threadpool(record_turn, request.session_id, request.message, answer)
+        finish_request("ask", "cache_hit")
+        return {"answer": answer, "cache_hit": True, "similarity": similarity}
+
+    try:
+        # Only the Messages API call holds a slot, not retrieval
+        system, messages = await run_in_threadpool(
+            prepare_claude, request.message, request.response_format, request.phase, session
+        )
+        async with admission.slot():
+            answer, stop_reason = await run_in_threadpool(call_claude, system, messages)
+    except Overloaded:
+        finish_request("ask", "rejected")
+        raise
+    except Exception:
+        finish_request("ask", "error")
+        raise
+    # Like /ask/stream: answers cut off at max_tokens are not cached
+    if stop_reason == "end_turn" and not has_history(session):
+        await run_in_threadpool(
+            cache_answer, request.message, answer, request.response_format, request.phase
+        )
+    if request.session_id:
+        await run_in_threadpool(record_turn, request.session_id, request.message, answer)
+    finish_request("ask", "answered")
+
+    return {"answer": answer, "cache_hit": False, "stop_reason": stop_reason}
+
+@app.get("/healthz")
+def api_healthz():
+
+    return {"status": "ok"}
+
+@app.get("/readyz")
+def api_readyz():
+
+    ready = all(readiness.values())
+    return JSONResponse(
+        {"ready": ready, **readiness, "startup_seconds": startup_seconds},
+        status_code=200 if ready else 503
+    )
+
+@app.get("/cache/stats")
+def api_cache_stats():
+
+    return cache_stats()
+
+@app.get("/embeddings/stats")
+def api_embedding_stats():
+
+    return query_batcher.stats()
+
+@app.get("/metrics")
+def api_metrics():
+
+    # With several workers each one only counts its own requests; in
+    # multiprocess mode the values are aggregated from PROMETHEUS_MULTIPROC_DIR
+    registry = REGISTRY
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
+@app.post("/ask/batch")
+async def api_ask_batch(request: Request):
+
+    body = (await request.body()).decode("utf-8", errors="replace")
+    items = parse_batch(body.splitlines())
+    if len(items) > BATCH_MAX_ITEMS:
+        return JSONResponse(
+            {"error": f"at most {BATCH_MAX_ITEMS} lines per batch"}, status_code=413
+        )
 
-    answer = ask_claude(request.message)
+    async def results():
+        counts = {}
+        # Stays "error" if the client goes away before the end
+        outcome = "error"
+        try:
+            async for result in run_batch(items, counts=counts):
+                yield result
+            if not counts["error"]:
+                outcome = "answered"
+            elif counts["answer"]:
+                outcome = "partial"
+        finally:
+            finish_request("ask_batch", outcome)
 
-    return {"answer": answer}
+    return StreamingResponse(
+        results(),
+        media_type="application/x-ndjson",
+        headers={"X-Accel-Buffering": "no"}
+    )
+
+@app.get("/admission/stats")
+def api_admission_stats():
+
+    return admission.stats()
+
+@app.post("/ask/stream")
+async def api_ask_stream(request: MessageRequest):
+
+    session = None
+    if request.session_id:
+        session = await run_in_threadpool(load_session, request.session_id)
+
+    cached = None
+    if not has_history(session):
+        cached = await run_in_threadpool(
+            cached_answer, request.message, request.response_format, request.phase
+        )
+    # Queue before any headers go out, so a full queue or an expired deadline
+    # is still a plain 503. The background task returns the slot if the
+    # client disconnects before the stream starts.
+    release = None
+    if not cached:
+        try:
+            release = await admission.acquire()
+        except Overloaded:
+            finish_request("ask_stream", "rejected")
+            raise
+
+    # Async, so the semaphore is released on the event loop, not in a thread
+    async def release_slot():
+        release()
+
+    return StreamingResponse(
+        stream_claude(
+            request.message, request.response_format, request.phase,
+            cached, release, request.session_id, session
+        ),
+        background=BackgroundTask(release_slot) if release else None,
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            # Stop nginx from buffering the event stream
+            "X-Accel-Buffering": "no",
+        }
+    )
+
+
+# ---------- MULTI-WORKER SERVING ----------
+
+# One process serializes embedding and search behind one GIL, so production
+# runs WEB_WORKERS processes on a shared listening socket. The parent runs
+# ingest and compiles the shared vector index once, in a spawned child so the
+# parent itself never starts torch's thread pools (they do not survive a
+# fork) or opens Chroma. It then loads the embedding model and the vector
+# index and forks the workers: both are shared copy-on-write rather than
+# loaded per worker. Chroma and SQLite handles must not cross a fork, so each
+# worker opens the collection itself, only to read documents (see SHARED
+# VECTOR INDEX), and the answer cache and session store on first use; the
+# BM25 arrays are memory-mapped and share the page cache.
+# ONNX Runtime sessions own thread pools too, so the onnx backends load in
+# each worker (the int8 model is ~23 MB), as does the small exemplar
+# collection. Workers that die are replaced.
+#
+# For aggregated /metrics set PROMETHEUS_MULTIPROC_DIR to an empty directory
+# (it has to be in the environment before startup).
+
+def run_worker(sock):
+    # startup_seconds of a replacement worker count from its own fork
+    global PROCESS_START
+    PROCESS_START = time.monotonic()
+    uvicorn.Server(uvicorn.Config(app)).run(sockets=[sock])
+
+def prepare_workers(ingest):
+    # Runs in a spawned child before the workers are forked
+    if ingest:
+        ingest_documents()
+    if SHARED_VECTOR_INDEX:
+        compile_vector_index()
 
+def serve_workers(workers, host="127.0.0.1", port=PORT):
+
+    if not SESSION_STORE:
+        raise ValueError(
+            "SESSION_STORE=0 with several workers would split every conversation "
+            "between them: unset it or set SESSION_STORE=1"
+        )
+
+    metrics_dir = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if metrics_dir:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+        os.makedirs(metrics_dir, exist_ok=True)
+    else:
+        print("PROMETHEUS_MULTIPROC_DIR is not set: /metrics shows one worker at a time")
+
+    prepare = multiprocessing.get_context("spawn").Process(
+        target=prepare_workers,
+        args=(os.getenv("INGEST_ON_STARTUP", "1") == "1",),
+        name="ingest"
+    )
+    prepare.start()
+    prepare.join()
+    # Workers inherit the environment: ingest has been done for them
+    os.environ["INGEST_ON_STARTUP"] = "0"
+
+    if prepare.exitcode != 0:
+        # The compiled index may be out of date: let the workers ask Chroma
+        print(
+            f"Ingest or the vector index failed with exit code {prepare.exitcode}, "
+            "serving the existing index from Chroma"
+        )
+    elif SHARED_VECTOR_INDEX:
+        resources["vector_index"] = load_vector_index()
+
+    if EMBED_BACKEND == "torch":
+        get_embed_model()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    context = multiprocessing.get_context("fork")
+    def start_worker():
+        process = context.Process(target=run_worker, args=(sock,), name="web-worker")
+        process.start()
+        return process
+
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+
+    processes = [start_worker() for _ in range(workers)]
+    print(f"Serving on {host}:{port} with {workers} workers: {[p.pid for p in processes]}")
+    try:
+        while not stopping.is_set():
+            multiprocessing.connection.wait([p.sentinel for p in processes], timeout=1)
+            for i, process in enumerate(processes):
+                if not process.is_alive() and not stopping.is_set():
+                    print(f"Worker {process.pid} exited with {process.exitcode}, restarting")
+                    if metrics_dir:
+                        multiprocess.mark_process_dead(process.pid)
+                    processes[i] = start_worker()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
 
 # ---------------- MAIN ----------------
 
 if __name__ == "__main__":
 
-    ingest_documents()
+    # `python professor_clone.py reindex` syncs the collection with ./docs and exits
+    if sys.argv[1:2] == ["reindex"]:
+        ingest_documents()
+        sys.exit(0)
+
+    # `python professor_clone.py export-snapshot DIR` / `import-snapshot DIR`
+    # move a built index between databases (see SNAPSHOTS)
+    if sys.argv[1:2] == ["export-snapshot"]:
+        export_snapshot(sys.argv[2])
+        sys.exit(0)
+    if sys.argv[1:2] == ["import-snapshot"]:
+        import_snapshot(sys.argv[2])
+        sys.exit(0)
+
+    # `python professor_clone.py batch questions.jsonl answers.jsonl` answers
+    # a JSONL file without starting the server
+    if sys.argv[1:2] == ["batch"]:
+        run_batch_file(sys.argv[2], sys.argv[3])
+        sys.exit(0)
+
+    # Otherwise the warm-up thread loads the model and ingests after the
+    # server has bound its port
+
+    if WEB_WORKERS > 1:
+        serve_workers(WEB_WORKERS)
+        sys.exit(0)
 
     print("\nServer running at:")
-    print("рџ‘‰ http://localhost:8000/docs\n")
+    print(f"рџ‘‰ http://localhost:{PORT}/docs\n")
 
-    uvicorn.run(app, host="127.0.0.1", port=8000)
\ No newline at end of file
+    uvicorn.run(app, host="127.0.0.1", port=PORT)
\ No newline at end of file
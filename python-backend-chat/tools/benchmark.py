@@ -0,0 +1,576 @@
+"""Offline benchmark for ingest, retrieval and /ask.
+
+    python tools/benchmark.py --output bench.json
+    python tools/benchmark.py --compare bench.json
+
+Everything runs in a scratch directory: a synthetic corpus of PDFs and DOCX
+files is generated there and ingested into a fresh professor_db, and the
+Anthropic clients are replaced by a local stub with configurable latency and
+streaming, so no API key or network access is needed (the embedding model
+must already be in the Hugging Face cache). The suite measures
+
+  - ingest throughput (files, pages and chunks per second),
+  - retrieve_context latency percentiles with the query caches cleared,
+  - /ask and /ask/stream throughput and latency under N concurrent clients
+    against a real uvicorn server,
+  - with --workers, /ask throughput and memory of the multi-worker server
+    (`python professor_clone.py` with WEB_WORKERS=n) at each worker count.
+    Those servers run as separate processes, so they reach the stub through
+    ANTHROPIC_BASE_URL, which serves the Messages API (plain and streaming).
+
+Results are printed and written as JSON; --compare prints the relative change
+of every metric against a stored run.
+
+Worker scaling: the Claude call is I/O and overlaps fine in one process, so
+with a slow stub one worker already keeps up; workers pay off once embedding
+and search dominate, i.e. with a fast stub (--llm-ttft 0 --llm-tokens 1) and
+high concurrency. Scaling across cores has not been measured: the only run so
+far had 1 CPU (10058 chunks, --concurrency 8, fast stub), where extra workers
+just compete for it and /ask went from 21.3 requests/sec with 1 worker to
+15.6 with 2 and 12.3 with 4. Repeat the run on a multi-core machine before
+choosing WEB_WORKERS.
+memory_pss_mb counts pages shared copy-on-write once, so it grows by far less
+than memory_rss_mb per extra worker; compare the two to see the shared model.
+memory_worker_private_mb is the mean private memory of a worker. Measured on
+1 CPU with 10058 chunks and the torch backend: a worker that has not served a
+query holds ~55 MB of its own; one that has holds 158-176 MB, against 184-201
+MB before the vector index was shared (each worker then loaded its own ~20 MB
+HNSW segment from Chroma). The compiled index (17 MB on disk) is loaded once in
+the parent. Most of the rest is the worker's Chroma client and SQLite caches
+(~40 MB) and torch's buffers for encoding. The mean depends on how requests
+spread over the workers, so compare runs with the same --requests.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+
+SERVICE_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(SERVICE_DIR))
+
+VOCABULARY = (
+    "humanism virtue politics republic prince Florence Bruni Petrarch Ficino "
+    "Plato Platonic Academy Medici eloquence rhetoric manuscript translation "
+    "Latin Greek philology commentary Aristotle Cicero history citizen "
+    "liberty tyranny education character meritocracy nobility patron "
+    "oration dialogue letter treatise reception tradition scholar library "
+    "Venice Rome papacy council Constantinople crusade Ottoman empire "
+    "studia humanitatis rudis indigestaque moles Kristeller Baron civic"
+).split()
+
+FILLER = (
+    "the of and in to that which was for with as by on from this his their "
+    "it is be were not an or had but are have also more than into"
+).split()
+
+
+# ---------- SYNTHETIC CORPUS ----------
+
+def sentence(rng):
+    words = [
+        rng.choice(VOCABULARY) if rng.random() < 0.4 else rng.choice(FILLER)
+        for _ in range(rng.randint(8, 24))
+    ]
+    return " ".join(words).capitalize() + "."
+
+
+def page_lines(rng, n_lines=45, width=90):
+    lines, line = [], ""
+    while len(lines) < n_lines:
+        for word in sentence(rng).split():
+            if len(line) + len(word) + 1 > width:
+                lines.append(line)
+                line = ""
+            line = f"{line} {word}".strip()
+    return lines[:n_lines]
+
+
+def pdf_escape(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_pdf(path, pages):
+    # Minimal single-font PDF: enough for pdfplumber to extract the text
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # page tree, filled in below
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    kids = []
+    for lines in pages:
+        body = "BT /F1 10 Tf 12 TL 50 790 Td " + " ".join(
+            f"({pdf_escape(line)}) Tj T*" for line in lines
+        ) + " ET"
+        stream = body.encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        content = len(objects)
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content
+        )
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(b"%d 0 R" % k for k in kids), len(kids)
+    )
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, obj in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % i + obj + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        out += b"%010d 00000 n \n" % offset
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(objects) + 1, xref
+    )
+    Path(path).write_bytes(bytes(out))
+
+
+def write_docx(path, rng, paragraphs):
+    import docx
+    document = docx.Document()
+    for _ in range(paragraphs):
+        document.add_paragraph(" ".join(sentence(rng) for _ in range(rng.randint(3, 8))))
+    document.save(path)
+
+
+def build_corpus(folder, n_pdfs, pages, n_docx, seed):
+    rng = random.Random(seed)
+    folder.mkdir(parents=True, exist_ok=True)
+    for i in range(n_pdfs):
+        write_pdf(folder / f"essay_{i:03d}.pdf", [page_lines(rng) for _ in range(pages)])
+    for i in range(n_docx):
+        write_docx(folder / f"notes_{i:03d}.docx", rng, paragraphs=40)
+    return n_pdfs * pages + n_docx
+
+
+def make_questions(n, seed):
+    rng = random.Random(seed + 1)
+    return [
+        "What did " + " ".join(rng.sample(VOCABULARY, rng.randint(2, 5))) + " mean?"
+        for _ in range(n)
+    ]
+
+
+# ---------- STUB CLAUDE ----------
+
+class StubClaude:
+
+    # Stands in for anthropic.Anthropic / AsyncAnthropic: waits `ttft` seconds
+    # before the first token, then emits `tokens` tokens at `tps` per second.
+
+    def __init__(self, ttft, tokens, tps):
+        self.ttft = ttft
+        self.tokens = tokens
+        self.tps = tps
+        self.messages = self
+
+    def usage(self, kwargs):
+        system = "".join(block["text"] for block in kwargs.get("system", []))
+        prompt = "".join(
+            m["content"] if isinstance(m["content"], str)
+            else "".join(block["text"] for block in m["content"])
+            for m in kwargs["messages"]
+        )
+        return SimpleNamespace(
+            input_tokens=len(prompt) // 4,
+            output_tokens=self.tokens,
+            cache_read_input_tokens=len(system) // 4,
+            cache_creation_input_tokens=0,
+        )
+
+    def text(self):
+        return " ".join(["word"] * self.tokens)
+
+    def create(self, **kwargs):
+        time.sleep(self.ttft + self.tokens / self.tps)
+        return SimpleNamespace(
+            content=[SimpleNamespace(text=self.text())],
+            usage=self.usage(kwargs),
+            stop_reason="end_turn",
+        )
+
+    def stream(self, **kwargs):
+        return StubStream(self, kwargs)
+
+
+class StubStream:
+
+    def __init__(self, stub, kwargs):
+        self.stub = stub
+        self.kwargs = kwargs
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    @property
+    async def text_stream(self):
+        await asyncio.sleep(self.stub.ttft)
+        for _ in range(self.stub.tokens):
+            await asyncio.sleep(1 / self.stub.tps)
+            yield "word "
+
+    async def get_final_message(self):
+        return SimpleNamespace(usage=self.stub.usage(self.kwargs), stop_reason="end_turn")
+
+
+def stub_api(stub):
+    # The same stub behind POST /v1/messages, for servers in other processes
+    from fastapi import FastAPI, Request
+    from fastapi.responses import StreamingResponse
+
+    api = FastAPI()
+
+    def event(name, data):
+        return f"event: {name}\ndata: {json.dumps({'type': name, **data})}\n\n"
+
+    async def events(body):
+        usage = vars(stub.usage(body))
+        yield event("message_start", {"message": {
+            "id": "msg_benchmark", "type": "message", "role": "assistant",
+            "model": body["model"], "content": [], "stop_reason": None,
+            "stop_sequence": None, "usage": {**usage, "output_tokens": 0},
+        }})
+        yield event("content_block_start", {"index": 0, "content_block": {"type": "text", "text": ""}})
+        await asyncio.sleep(stub.ttft)
+        for _ in range(stub.tokens):
+            await asyncio.sleep(1 / stub.tps)
+            yield event("content_block_delta", {"index": 0, "delta": {"type": "text_delta", "text": "word "}})
+        yield event("content_block_stop", {"index": 0})
+        yield event("message_delta", {
+            "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+            "usage": {"output_tokens": stub.tokens},
+        })
+        yield event("message_stop", {})
+
+    @api.post("/v1/messages")
+    async def messages(request: Request):
+        body = await request.json()
+        if body.get("stream"):
+            return StreamingResponse(events(body), media_type="text/event-stream")
+        await asyncio.sleep(stub.ttft + stub.tokens / stub.tps)
+        return {
+            "id": "msg_benchmark", "type": "message", "role": "assistant",
+            "model": body["model"], "content": [{"type": "text", "text": stub.text()}],
+            "stop_reason": "end_turn", "stop_sequence": None,
+            "usage": vars(stub.usage(body)),
+        }
+
+    return api
+
+
+# ---------- MEASUREMENTS ----------
+
+def percentiles(samples):
+    samples = np.asarray(samples) * 1000
+    return {
+        "count": int(len(samples)),
+        "mean_ms": float(samples.mean()),
+        "p50_ms": float(np.percentile(samples, 50)),
+        "p95_ms": float(np.percentile(samples, 95)),
+        "p99_ms": float(np.percentile(samples, 99)),
+    }
+
+
+def bench_ingest(pc, pages):
+    start = time.perf_counter()
+    pc.ingest_documents()
+    seconds = time.perf_counter() - start
+    manifest = pc.load_manifest()
+    chunks = sum(entry["chunks"] for entry in manifest.values())
+    return {
+        "seconds": seconds,
+        "files": len(manifest),
+        "pages": pages,
+        "chunks": chunks,
+        "files_per_sec": len(manifest) / seconds,
+        "pages_per_sec": pages / seconds,
+        "chunks_per_sec": chunks / seconds,
+        "embed_cache_hit_rate": pc.embedding_cache.stats()["hit_rate"],
+    }
+
+
+def bench_retrieval(pc, questions):
+    pc.retrieve_context(questions[0])  # warm-up
+    samples = []
+    for question in questions:
+        pc.embed_query.cache_clear()
+        pc.retrieval_cache.clear()
+        start = time.perf_counter()
+        pc.retrieve_context(question)
+        samples.append(time.perf_counter() - start)
+    return percentiles(samples)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(app):
+    import uvicorn
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, f"http://127.0.0.1:{port}"
+
+
+def start_workers(workdir, workers, api_url):
+    import httpx
+    port = free_port()
+    env = {
+        **os.environ,
+        "WEB_WORKERS": str(workers),
+        "PORT": str(port),
+        "ANTHROPIC_BASE_URL": api_url,
+        "INGEST_ON_STARTUP": "0",
+    }
+    log = open(workdir / f"workers-{workers}.log", "w")
+    process = subprocess.Popen(
+        [sys.executable, str(SERVICE_DIR / "professor_clone.py")],
+        cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT,
+    )
+    url = f"http://127.0.0.1:{port}"
+    # Requests land on any worker: wait until a run of them all report ready
+    ready = 0
+    while ready < 5 * workers:
+        if process.poll() is not None:
+            raise RuntimeError(f"server exited with {process.returncode}, see {log.name}")
+        try:
+            ready = ready + 1 if httpx.get(f"{url}/readyz").status_code == 200 else 0
+        except httpx.HTTPError:
+            ready = 0
+        if not ready:
+            time.sleep(0.5)
+    return process, url
+
+
+def process_tree_memory(pid):
+    # Rss counts shared pages in every process; Pss splits them between the
+    # processes that map them, so its sum is the real footprint. A worker's
+    # private pages (Private_Clean + Private_Dirty) are what each extra
+    # worker costs.
+    totals, pids = {"Rss:": 0, "Pss:": 0}, [pid]
+    private = []
+    while pids:
+        current = pids.pop()
+        try:
+            own = 0
+            with open(f"/proc/{current}/smaps_rollup") as f:
+                for line in f:
+                    key = line.split()[0]
+                    if key in totals:
+                        totals[key] += int(line.split()[1])
+                    elif key in ("Private_Clean:", "Private_Dirty:"):
+                        own += int(line.split()[1])
+            with open(f"/proc/{current}/cmdline", "rb") as f:
+                # Forked workers run the parent's command line; leave out
+                # multiprocessing's resource tracker
+                if current != pid and b"multiprocessing" not in f.read():
+                    private.append(own)
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as f:
+                    pids += [int(child) for child in f.read().split()]
+        except OSError:
+            continue
+    return {
+        "memory_rss_mb": totals["Rss:"] / 1024,
+        "memory_pss_mb": totals["Pss:"] / 1024,
+        "memory_worker_private_mb": sum(private) / len(private) / 1024 if private else None,
+    }
+
+
+def bench_workers(workdir, counts, questions, concurrency, requests, api_url):
+    results = {}
+    for workers in counts:
+        print(f"Workers: {workers}...")
+        process, url = start_workers(workdir, workers, api_url)
+        try:
+            result = asyncio.run(load_test(url, questions, concurrency, requests, False))
+            result.update(process_tree_memory(process.pid))
+            results[f"w{workers}"] = result
+        finally:
+            process.terminate()
+            process.wait()
+    return results
+
+
+async def load_test(url, questions, concurrency, requests, stream):
+    import httpx
+
+    queue = asyncio.Queue()
+    for i in range(requests):
+        queue.put_nowait(questions[i % len(questions)])
+    latencies, first_tokens, errors = [], [], 0
+
+    async def client(http):
+        nonlocal errors
+        while not queue.empty():
+            body = {
+                "message": queue.get_nowait(),
+                "response_format": "Answer a Question",
+                "phase": "Late Hankins (2019+)",
+            }
+            start = time.perf_counter()
+            try:
+                if stream:
+                    async with http.stream("POST", f"{url}/ask/stream", json=body) as r:
+                        r.raise_for_status()
+                        first = None
+                        async for line in r.aiter_lines():
+                            if first is None and line.startswith("event: token"):
+                                first = time.perf_counter() - start
+                        if first is not None:
+                            first_tokens.append(first)
+                else:
+                    r = await http.post(f"{url}/ask", json=body)
+                    r.raise_for_status()
+                latencies.append(time.perf_counter() - start)
+            except httpx.HTTPError:
+                errors += 1
+
+    start = time.perf_counter()
+    async with httpx.AsyncClient(timeout=600) as http:
+        await asyncio.gather(*(client(http) for _ in range(concurrency)))
+    seconds = time.perf_counter() - start
+
+    result = {
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": errors,
+        "seconds": seconds,
+        "requests_per_sec": len(latencies) / seconds,
+        "latency": percentiles(latencies) if latencies else None,
+    }
+    if stream and first_tokens:
+        result["first_token"] = percentiles(first_tokens)
+    return result
+
+
+def flatten(report, prefix=""):
+    out = {}
+    for key, value in report.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            out.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            out[name] = value
+    return out
+
+
+def compare(report, baseline):
+    current, previous = flatten(report), flatten(baseline)
+    print(f"\n{'metric':<46} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name, value in current.items():
+        if name.startswith("config.") or name not in previous:
+            continue
+        if name.rsplit(".", 1)[-1] in ("count", "concurrency", "requests"):
+            continue
+        before = previous[name]
+        change = (value - before) / before * 100 if before else 0.0
+        print(f"{name:<46} {before:>12.2f} {value:>12.2f} {change:>+7.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark for the professor service")
+    parser.add_argument("--pdfs", type=int, default=20)
+    parser.add_argument("--pages", type=int, default=10, help="pages per PDF")
+    parser.add_argument("--docx", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=64, help="requests per concurrency level")
+    parser.add_argument("--llm-ttft", type=float, default=0.5, help="stub seconds to first token")
+    parser.add_argument("--llm-tokens", type=int, default=200, help="stub tokens per answer")
+    parser.add_argument("--llm-tps", type=float, default=100.0, help="stub tokens per second")
+    parser.add_argument("--workers", type=int, nargs="+", default=[],
+                        help="also load-test the multi-worker server with these worker counts")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", help="keep the corpus and database here")
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--compare", help="baseline JSON report to compare with")
+    args = parser.parse_args()
+
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix="professor-bench-")).resolve()
+    shutil.rmtree(workdir / "professor_db", ignore_errors=True)
+    shutil.rmtree(workdir / "embed_cache", ignore_errors=True)
+    pages = build_corpus(workdir / "docs", args.pdfs, args.pages, args.docx, args.seed)
+    questions = make_questions(args.queries, args.seed)
+
+    # The service resolves ./docs and ./professor_db against the working
+    # directory, so import it from inside the scratch directory
+    os.chdir(workdir)
+    os.environ.setdefault("ANTHROPIC_API_KEY", "benchmark")
+    import professor_clone as pc
+
+    stub = StubClaude(args.llm_ttft, args.llm_tokens, args.llm_tps)
+    pc.resources["claude"] = stub
+    pc.resources["async_claude"] = stub
+
+    report = {
+        "config": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "embed_backend": pc.EMBED_BACKEND,
+            "cpus": os.cpu_count(),
+            **{k: v for k, v in vars(args).items() if k not in ("output", "compare", "workdir")},
+        }
+    }
+
+    print("Ingest...")
+    report["ingest"] = bench_ingest(pc, pages)
+    print("Retrieval...")
+    report["retrieval"] = bench_retrieval(pc, questions)
+
+    print("Load test...")
+    # bench_ingest has built the index: the lifespan warm-up must not
+    # re-run ingest inside the measured server
+    os.environ["INGEST_ON_STARTUP"] = "0"
+    server, url = start_server(pc.app)
+    for mode in ("ask", "ask_stream"):
+        report[mode] = {}
+        for concurrency in args.concurrency:
+            pc.embed_query.cache_clear()
+            pc.retrieval_cache.clear()
+            report[mode][f"c{concurrency}"] = asyncio.run(load_test(
+                url, questions, concurrency, args.requests, mode == "ask_stream"
+            ))
+    server.should_exit = True
+
+    if args.workers:
+        api, api_url = start_server(stub_api(stub))
+        report["workers"] = bench_workers(
+            workdir, args.workers, questions, max(args.concurrency), args.requests, api_url
+        )
+        api.should_exit = True
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
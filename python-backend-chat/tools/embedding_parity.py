@@ -0,0 +1,144 @@
+"""Compare an embedding backend against the default one.
+
+Run from python-backend-chat/ (the service's working directory):
+
+    python tools/embedding_parity.py --backend onnx-int8
+
+Queries come from --queries (one per line) or are sampled from the stored
+chunks. For each backend the script encodes the queries, runs them against
+the collection and reports top-k overlap with the baseline, vector cosine
+agreement and encode throughput. Exits with status 1 when the mean overlap
+falls below --tolerance.
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import professor_clone as pc  # noqa: E402
+
+
+def sample_queries(collection, n, seed):
+    ids = collection.get(include=[])["ids"]
+    random.Random(seed).shuffle(ids)
+    documents = collection.get(ids=ids[:n], include=["documents"])["documents"]
+    # The opening words of a chunk make a reasonable stand-in for a question
+    return [" ".join(d.split()[:24]) for d in documents if d.strip()]
+
+
+def time_encode(model, texts, batch_size, repeat):
+    model.encode(texts[:batch_size], batch_size=batch_size)  # warm-up
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        vectors = model.encode(texts, batch_size=batch_size)
+        best = min(best, time.perf_counter() - start)
+    return np.asarray(vectors, dtype=np.float32), best
+
+
+def single_query_ms(model, texts, repeat):
+    times = []
+    for text in texts[:repeat]:
+        start = time.perf_counter()
+        model.encode([text])
+        times.append(time.perf_counter() - start)
+    return 1000 * float(np.median(times))
+
+
+def top_k(collection, vectors, k):
+    results = collection.query(query_embeddings=vectors.tolist(), n_results=k)
+    return results["ids"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backend", default="onnx-int8")
+    parser.add_argument("--baseline", default="torch")
+    parser.add_argument("--queries", help="text file, one query per line")
+    parser.add_argument("--samples", type=int, default=100)
+    parser.add_argument("--k", type=int, default=pc.N_RESULTS)
+    parser.add_argument("--batch-size", type=int, default=pc.EMBED_BATCH_SIZE)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--tolerance", type=float, default=0.9)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write the report here as well")
+    args = parser.parse_args()
+
+    collection = pc.get_collection()
+    if collection.count() == 0:
+        sys.exit("collection is empty: ingest documents first")
+
+    if args.queries:
+        queries = [q.strip() for q in open(args.queries, encoding="utf-8") if q.strip()]
+    else:
+        queries = sample_queries(collection, args.samples, args.seed)
+    passages = collection.get(
+        limit=max(args.samples, args.batch_size), include=["documents"]
+    )["documents"]
+
+    report = {"queries": len(queries), "k": args.k, "backends": {}}
+    hits = {}
+    query_vectors = {}
+    for backend in (args.baseline, args.backend):
+        model = pc.load_embed_model(backend)
+        vectors, _ = time_encode(model, queries, args.batch_size, 1)
+        _, seconds = time_encode(model, passages, args.batch_size, args.repeat)
+        query_vectors[backend] = vectors
+        hits[backend] = top_k(collection, vectors, args.k)
+        report["backends"][backend] = {
+            "dimension": int(vectors.shape[1]),
+            "passages_per_sec": len(passages) / seconds,
+            "single_query_ms": single_query_ms(model, queries, 50),
+        }
+        del model
+
+    base, cand = query_vectors[args.baseline], query_vectors[args.backend]
+    if base.shape[1] != cand.shape[1]:
+        sys.exit(f"dimension mismatch: {base.shape[1]} vs {cand.shape[1]}")
+
+    overlaps = [
+        len(set(a) & set(b)) / max(len(a), 1)
+        for a, b in zip(hits[args.baseline], hits[args.backend])
+    ]
+    cosines = (base * cand).sum(axis=1) / (
+        np.linalg.norm(base, axis=1) * np.linalg.norm(cand, axis=1)
+    )
+    b, c = report["backends"][args.baseline], report["backends"][args.backend]
+    report.update({
+        "overlap_mean": float(np.mean(overlaps)),
+        "overlap_min": float(np.min(overlaps)),
+        "cosine_mean": float(np.mean(cosines)),
+        "cosine_min": float(np.min(cosines)),
+        "throughput_speedup": c["passages_per_sec"] / b["passages_per_sec"],
+        "latency_speedup": b["single_query_ms"] / c["single_query_ms"],
+        "tolerance": args.tolerance,
+    })
+    report["passed"] = report["overlap_mean"] >= args.tolerance
+
+    print(f"queries {len(queries)}, k {args.k}")
+    print(f"{'backend':<12} {'passages/sec':>13} {'query ms':>9}")
+    for name, row in report["backends"].items():
+        print(f"{name:<12} {row['passages_per_sec']:>13.1f} {row['single_query_ms']:>9.2f}")
+    print(f"top-{args.k} overlap mean {report['overlap_mean']:.3f} min {report['overlap_min']:.3f}")
+    print(f"cosine mean {report['cosine_mean']:.4f} min {report['cosine_min']:.4f}")
+    print(
+        f"speedup throughput x{report['throughput_speedup']:.2f}, "
+        f"latency x{report['latency_speedup']:.2f}"
+    )
+    print("PASS" if report["passed"] else "FAIL")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    sys.exit(0 if report["passed"] else 1)
+
+
+if __name__ == "__main__":
+    main()
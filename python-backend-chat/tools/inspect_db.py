@@ -1,26 +1,321 @@
+"""Profile the vector index and measure HNSW settings.
+
+Run from python-backend-chat/ (the service's working directory):
+
+    python tools/inspect_db.py
+    python tools/inspect_db.py --sweep --m 8,16,32 --ef-search 10,20,50,100
+
+Reports chunks per source file, the chunk length distribution in tokens, the
+on-disk size of everything under professor_db/ (and the embedding cache), and
+the memory taken by loading the HNSW index. It then replays a query set
+against the collection, reporting latency percentiles and recall@k against
+exact brute-force search over the stored embeddings. With --sweep it builds
+an hnswlib index (the library Chroma uses underneath) for each M and
+ef_construction and queries it at each ef_search, so the speed/recall
+trade-off can be read off one table. New settings take effect through
+HNSW_M / HNSW_CONSTRUCTION_EF / HNSW_SEARCH_EF on a newly created collection,
+e.g. export-snapshot, remove professor_db, import-snapshot.
+"""
+
+import argparse
+import json
+import os
+import random
 import sqlite3
+import sys
+import time
 from pathlib import Path
 
-DB = Path(__file__).resolve().parents[1] / "professor_db" / "chroma.sqlite3"
-
-print("db", DB)
-print("exists", DB.exists())
-if DB.exists():
-    print("size", DB.stat().st_size)
-
-con = sqlite3.connect(str(DB))
-cur = con.cursor()
-cur.execute("select name from sqlite_master where type='table' order by name")
-tables = [r[0] for r in cur.fetchall()]
-print("tables", len(tables))
-for t in tables:
-    print(" -", t)
-
-# quick sanity check on a few common tables
-for candidate in ["collections", "segments", "embeddings", "tenants", "databases", "collection_metadata"]:
-    if candidate in tables:
-        try:
-            cur.execute(f"select count(*) from {candidate}")
-            print(f"{candidate}.count", cur.fetchone()[0])
-        except Exception as e:
-            print(f"{candidate}.count error", e)
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import professor_clone as pc  # noqa: E402
+
+CHROMA_HNSW_DEFAULTS = {"hnsw:space": "l2", "hnsw:M": 16, "hnsw:construction_ef": 100, "hnsw:search_ef": 10}
+
+
+def percentiles(values, points=(50, 90, 99)):
+    if not len(values):
+        return {}
+    return {f"p{p}": float(np.percentile(values, p)) for p in points}
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def load_chunks(collection, page_size=1000):
+    ids, documents, metadatas, embeddings = [], [], [], []
+    offset = 0
+    while True:
+        page = collection.get(
+            include=["documents", "metadatas", "embeddings"],
+            limit=page_size, offset=offset
+        )
+        if not page["ids"]:
+            break
+        ids += page["ids"]
+        documents += page["documents"]
+        metadatas += page["metadatas"]
+        embeddings.append(np.asarray(page["embeddings"], dtype=np.float32))
+        offset += len(page["ids"])
+    return ids, documents, metadatas, np.concatenate(embeddings)
+
+
+def source_report(ids, documents, metadatas):
+    sources = {}
+    tokens = []
+    for chunk_id, document, metadata in zip(ids, documents, metadatas):
+        name = (metadata or {}).get("source") or chunk_id.rpartition("_")[0]
+        sources[name] = sources.get(name, 0) + 1
+        tokens.append(pc.count_tokens(document, metadata))
+    tokens = np.array(tokens)
+    edges = [0, 32, 64, 128, 192, pc.CHUNK_TOKENS, max(int(tokens.max()) + 1, pc.CHUNK_TOKENS + 1)]
+    histogram = np.histogram(tokens, bins=edges)[0]
+    return {
+        "sources": dict(sorted(sources.items(), key=lambda item: -item[1])),
+        "tokens": {
+            "mean": float(tokens.mean()),
+            "min": int(tokens.min()),
+            "max": int(tokens.max()),
+            **percentiles(tokens, (10, 50, 90, 99)),
+            "histogram": {
+                f"{a}-{b - 1}": int(n) for a, b, n in zip(edges, edges[1:], histogram)
+            },
+        },
+    }
+
+
+def directory_bytes(path):
+    path = Path(path)
+    if path.is_file():
+        return path.stat().st_size
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+
+
+def storage_report():
+    parts = {}
+    db = Path(pc.DB_PATH)
+    if db.is_dir():
+        for entry in sorted(db.iterdir()):
+            # Chroma keeps each HNSW segment in a UUID-named directory
+            kind = "hnsw segment" if (entry / "header.bin").exists() else entry.name
+            parts[kind] = parts.get(kind, 0) + directory_bytes(entry)
+    if os.path.isdir(pc.EMBED_CACHE_PATH):
+        parts["embedding cache"] = directory_bytes(pc.EMBED_CACHE_PATH)
+    return parts
+
+
+def chroma_tables():
+    path = os.path.join(pc.DB_PATH, "chroma.sqlite3")
+    con = sqlite3.connect(path)
+    tables = [r[0] for r in con.execute(
+        "select name from sqlite_master where type='table' order by name"
+    )]
+    return {t: con.execute(f'select count(*) from "{t}"').fetchone()[0] for t in tables}
+
+
+def hnsw_memory_estimate(n, dim, m):
+    # hnswlib: level 0 holds the vector, 2*M links and a label per element;
+    # about 1/M of the elements also sit on upper levels with M links each
+    level0 = n * (dim * 4 + 2 * m * 4 + 4 + 8)
+    upper = n / max(m, 2) * (m * 4 + 4)
+    return int(level0 + upper)
+
+
+def exact_top_k(embeddings, queries, k):
+    # Squared L2, what Chroma's default "l2" space ranks by
+    norms = (embeddings ** 2).sum(axis=1)
+    top = []
+    for q in queries:
+        distances = norms - 2 * embeddings @ q
+        best = np.argpartition(distances, k - 1)[:k]
+        top.append(set(best[np.argsort(distances[best])].tolist()))
+    return top
+
+
+def recall(found, exact):
+    return float(np.mean([len(f & e) / len(e) for f, e in zip(found, exact)]))
+
+
+def sample_queries(documents, n, seed):
+    picked = random.Random(seed).sample(documents, min(n, len(documents)))
+    # The opening words of a chunk make a reasonable stand-in for a question
+    return [" ".join(d.split()[:24]) for d in picked if d.strip()]
+
+
+def replay(collection, ids, query_vectors, exact, k):
+    index = {chunk_id: i for i, chunk_id in enumerate(ids)}
+    rss = rss_bytes()
+    start = time.perf_counter()
+    collection.query(query_embeddings=query_vectors[:1].tolist(), n_results=k)
+    first = time.perf_counter() - start
+    loaded = rss_bytes()
+
+    times, found = [], []
+    for vector in query_vectors:
+        start = time.perf_counter()
+        result = collection.query(
+            query_embeddings=[vector.tolist()], n_results=k, include=["distances"]
+        )
+        times.append(time.perf_counter() - start)
+        found.append({index[i] for i in result["ids"][0]})
+    return {
+        "first_query_ms": 1000 * first,
+        "load_rss_bytes": loaded - rss if rss is not None and loaded is not None else None,
+        "latency_ms": {
+            "mean": 1000 * float(np.mean(times)),
+            **{p: 1000 * v for p, v in percentiles(times).items()},
+        },
+        f"recall@{k}": recall(found, exact),
+    }
+
+
+def sweep(embeddings, query_vectors, exact, k, ms, constructions, searches, threads):
+    import hnswlib
+
+    rows = []
+    for m in ms:
+        for construction in constructions:
+            index = hnswlib.Index(space="l2", dim=embeddings.shape[1])
+            index.init_index(max_elements=len(embeddings), ef_construction=construction, M=m)
+            index.set_num_threads(threads)
+            start = time.perf_counter()
+            index.add_items(embeddings, np.arange(len(embeddings)))
+            build = time.perf_counter() - start
+            index.set_num_threads(1)
+            for search in searches:
+                index.set_ef(max(search, k))
+                times, found = [], []
+                for vector in query_vectors:
+                    start = time.perf_counter()
+                    labels, _ = index.knn_query(vector, k=k)
+                    times.append(time.perf_counter() - start)
+                    found.append(set(labels[0].tolist()))
+                rows.append({
+                    "M": m,
+                    "ef_construction": construction,
+                    "ef_search": search,
+                    "build_s": build,
+                    "memory_bytes": hnsw_memory_estimate(len(embeddings), embeddings.shape[1], m),
+                    "latency_us_p50": 1e6 * float(np.percentile(times, 50)),
+                    "latency_us_p99": 1e6 * float(np.percentile(times, 99)),
+                    f"recall@{k}": recall(found, exact),
+                })
+    return rows
+
+
+def int_list(value):
+    return [int(v) for v in value.split(",") if v]
+
+
+def mb(n):
+    return f"{n / 2**20:.1f} MB" if n is not None else "n/a"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--queries", help="text file, one query per line")
+    parser.add_argument("--samples", type=int, default=200)
+    parser.add_argument("--k", type=int, default=pc.N_RESULTS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--sweep", action="store_true", help="run the HNSW parameter sweep")
+    parser.add_argument("--m", type=int_list, default=[8, 16, 32])
+    parser.add_argument("--ef-construction", type=int_list, default=[100, 200])
+    parser.add_argument("--ef-search", type=int_list, default=[10, 20, 50, 100])
+    parser.add_argument("--threads", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--tables", action="store_true", help="also list chroma.sqlite3 tables")
+    parser.add_argument("--json", help="write the report here as well")
+    args = parser.parse_args()
+
+    collection = pc.get_collection()
+    if collection.count() == 0:
+        sys.exit("collection is empty: ingest documents first")
+
+    ids, documents, metadatas, embeddings = load_chunks(collection)
+    settings = {**CHROMA_HNSW_DEFAULTS, **(collection.metadata or {})}
+    report = {
+        "chunks": len(ids),
+        "dimension": int(embeddings.shape[1]),
+        "hnsw": {key: value for key, value in settings.items() if key.startswith("hnsw:")},
+        **source_report(ids, documents, metadatas),
+        "disk_bytes": storage_report(),
+    }
+    if args.tables:
+        report["chroma_tables"] = chroma_tables()
+
+    print(f"chunks {len(ids)}, dimension {embeddings.shape[1]}, {len(report['sources'])} sources")
+    print("hnsw " + ", ".join(f"{k[5:]}={v}" for k, v in report["hnsw"].items()))
+    print(f"\n{'source':<48} {'chunks':>7}")
+    for name, n in report["sources"].items():
+        print(f"{name[:48]:<48} {n:>7}")
+    t = report["tokens"]
+    print(
+        f"\ntokens per chunk: mean {t['mean']:.0f}, min {t['min']}, p10 {t['p10']:.0f}, "
+        f"p50 {t['p50']:.0f}, p90 {t['p90']:.0f}, p99 {t['p99']:.0f}, max {t['max']}"
+    )
+    for bucket, n in t["histogram"].items():
+        print(f"  {bucket:>9} {n:>6} {'#' * round(40 * n / len(ids))}")
+    print("\ndisk")
+    for part, n in sorted(report["disk_bytes"].items(), key=lambda item: -item[1]):
+        print(f"  {part:<28} {mb(n):>10}")
+    print(f"  {'total':<28} {mb(sum(report['disk_bytes'].values())):>10}")
+    if args.tables:
+        print("\nchroma.sqlite3 tables")
+        for table, n in report["chroma_tables"].items():
+            print(f"  {table:<40} {n:>8}")
+
+    if args.queries:
+        queries = [q.strip() for q in open(args.queries, encoding="utf-8") if q.strip()]
+    else:
+        queries = sample_queries(documents, args.samples, args.seed)
+    k = min(args.k, len(ids))
+    query_vectors = np.asarray(
+        pc.get_embed_model().encode(queries, batch_size=pc.EMBED_BATCH_SIZE), dtype=np.float32
+    )
+    exact = exact_top_k(embeddings, query_vectors, k)
+
+    report["replay"] = {"queries": len(queries), "k": k, **replay(collection, ids, query_vectors, exact, k)}
+    r = report["replay"]
+    print(f"\nreplay: {len(queries)} queries, k {k}")
+    print(
+        f"  first query {r['first_query_ms']:.1f} ms, index load RSS {mb(r['load_rss_bytes'])}, "
+        f"estimated HNSW memory "
+        f"{mb(hnsw_memory_estimate(len(ids), embeddings.shape[1], report['hnsw']['hnsw:M']))}"
+    )
+    lat = r["latency_ms"]
+    print(
+        f"  latency mean {lat['mean']:.2f} ms, p50 {lat['p50']:.2f}, "
+        f"p90 {lat['p90']:.2f}, p99 {lat['p99']:.2f}"
+    )
+    print(f"  recall@{k} vs exact search {r[f'recall@{k}']:.3f}")
+
+    if args.sweep:
+        rows = sweep(
+            embeddings, query_vectors, exact, k,
+            args.m, args.ef_construction, args.ef_search, args.threads
+        )
+        report["sweep"] = rows
+        print(
+            f"\n{'M':>4} {'ef_constr':>9} {'ef_search':>9} {'build s':>8} "
+            f"{'memory':>10} {'p50 us':>8} {'p99 us':>8} {f'recall@{k}':>9}"
+        )
+        for row in rows:
+            print(
+                f"{row['M']:>4} {row['ef_construction']:>9} {row['ef_search']:>9} "
+                f"{row['build_s']:>8.2f} {mb(row['memory_bytes']):>10} "
+                f"{row['latency_us_p50']:>8.0f} {row['latency_us_p99']:>8.0f} "
+                f"{row[f'recall@{k}']:>9.3f}"
+            )
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()